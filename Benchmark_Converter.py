@@ -0,0 +1,214 @@
+import argparse
+import io
+import json
+import platform
+import shutil
+import tempfile
+import time
+from os import chdir, getcwd, makedirs, path
+
+import numpy as np
+from PIL import Image
+
+from Updated_Converter import MosaicCreator, MosaicMetrics, get_child_cpu_time, list_directory
+
+# Synthetic workloads, from quick smoke tests up to a realistic library size
+# main_size is (width, height) of the main image, tile_sizes are the micro-image sizes cycled through
+SCALES = {
+    'tiny': {'tile_count': 20, 'block_size': 4, 'main_size': (96, 64), 'tile_sizes': [(64, 48), (48, 64)]},
+    'small': {'tile_count': 100, 'block_size': 8, 'main_size': (320, 240), 'tile_sizes': [(160, 120), (120, 160)]},
+    'medium': {'tile_count': 1000, 'block_size': 8, 'main_size': (640, 480), 'tile_sizes': [(320, 240), (240, 320)]},
+    'large': {'tile_count': 5000, 'block_size': 8, 'main_size': (1280, 960), 'tile_sizes': [(640, 426), (426, 640)]},
+}
+
+STAGES = ('ingest', 'resize', 'features', 'matching', 'paste', 'encode', 'create_mosaic')
+
+
+def make_synthetic_image(random, size):
+    """
+    Makes a smooth random image, so that micro-images have distinct colours but still compress like photographs.
+
+    :param random: NumPy random generator.
+    :param size: (width, height) of the image.
+    :return: The image.
+    """
+
+    coarse = random.integers(0, 256, (random.integers(2, 8), random.integers(2, 8), 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize(size, Image.BILINEAR)
+    noise = random.normal(0, 8, (size[1], size[0], 3))
+    return Image.fromarray(np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8))
+
+
+def make_workload(directory, scale, seed=0):
+    """
+    Writes a synthetic main image and micro-image library to a directory.
+
+    :param directory: Directory to write to.
+    :param scale: One of the SCALES dictionaries.
+    :param seed: Random seed, so repeated runs time the same images.
+    :return: The path of the main image, and the paths of the micro-images.
+    """
+
+    random = np.random.default_rng(seed)
+    tile_folder = path.join(directory, 'tiles')
+    makedirs(tile_folder, exist_ok=True)
+    for index in range(scale['tile_count']):
+        tile_size = scale['tile_sizes'][index % len(scale['tile_sizes'])]
+        make_synthetic_image(random, tile_size).save(path.join(tile_folder, '%06d.jpg' % index), quality=90)
+
+    main_image = path.join(directory, 'main.jpg')
+    make_synthetic_image(random, scale['main_size']).save(main_image, quality=90)
+    return main_image, sorted(list_directory(tile_folder))
+
+
+class StageTimer:
+    """
+    Times a stage in wall clock time, CPU time of this process and CPU time of finished child processes.
+    """
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.child_cpu = get_child_cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.results[self.name] = {
+            'wall': time.perf_counter() - self.wall,
+            'cpu': time.process_time() - self.cpu,
+            'child_cpu': get_child_cpu_time() - self.child_cpu,
+        }
+
+
+def run_stages(mosaic_creator, main_image_path, micro_images):
+    """
+    Runs each stage of MosaicCreator.create_mosaic separately, then create_mosaic itself.
+
+    :param mosaic_creator: The configured MosaicCreator.
+    :param main_image_path: Path of the main image.
+    :param micro_images: Paths of the micro-images.
+    :return: Dictionary of stage name to timings.
+    """
+
+    results = {}
+    main_image = Image.open(main_image_path)
+    mosaic_creator.image_width, mosaic_creator.image_height = main_image.size
+    tile_side = min(mosaic_creator.get_max_tile_side(),
+                    min(mosaic_creator.get_fitted_side(*Image.open(image).size) for image in micro_images))
+
+    # Ingest as create_mosaic does it: draft decoding, resizing and measuring in the process pool
+    with StageTimer(results, 'ingest'):
+        tile_side, blocked_micro_images = mosaic_creator.load_micro_image_blocks(micro_images, tile_side)
+
+    # The parts of ingest on their own, in this process
+    with StageTimer(results, 'resize'):
+        resized_images = [mosaic_creator.prepare_micro_image(image_path, tile_side) for image_path in micro_images]
+
+    with StageTimer(results, 'features'):
+        segment_size = tile_side // mosaic_creator.block_size
+        for image in resized_images:
+            mosaic_creator.get_block_averages(mosaic_creator.get_pixel_array(image), segment_size)
+    del resized_images
+
+    with StageTimer(results, 'matching'):
+        colour_array = mosaic_creator.get_pixel_array(main_image)
+        image_array = mosaic_creator.find_closest_image(colour_array, blocked_micro_images)
+
+    with StageTimer(results, 'paste'):
+        collage = mosaic_creator.assemble_collage(image_array, tile_side)
+
+    with StageTimer(results, 'encode'):
+        Image.fromarray(collage).save(io.BytesIO(), 'JPEG')
+    del collage, image_array, blocked_micro_images
+
+    mosaic_creator.metrics = MosaicMetrics()
+    plan = mosaic_creator.plan_job(micro_images, [main_image_path])
+    with StageTimer(results, 'create_mosaic'):
+        mosaic_creator.create_mosaic(micro_images, main_image_path)
+    # Breakdown of the full run from create_mosaic's own instrumentation
+    results['create_mosaic']['metrics'] = mosaic_creator.metrics.as_dict()
+    # The planner's estimates, to check against the measured peak and the collage written
+    results['create_mosaic']['estimated_peak_rss'] = plan['process_bytes']
+    results['create_mosaic']['peak_rss'] = max(span['peak_rss'] for span in mosaic_creator.metrics.spans)
+    results['create_mosaic']['estimated_output_bytes'] = plan['output_bytes']
+    return results
+
+
+def run_benchmark(scale_names, repeats=1, creator_options=None):
+    """
+    Generates each workload and times it.
+
+    :param scale_names: Names of entries in SCALES.
+    :param repeats: Number of times to time each workload. The fastest wall time of each stage is reported.
+    :param creator_options: Keyword arguments for MosaicCreator.
+    :return: Array of result dictionaries, one per scale.
+    """
+
+    creator_options = creator_options or {}
+    results = []
+    for scale_name in scale_names:
+        scale = SCALES[scale_name]
+        directory = tempfile.mkdtemp(prefix='mosaic_benchmark_')
+        working_directory = getcwd()
+        try:
+            print("Generating", scale_name, "workload")
+            main_image, micro_images = make_workload(directory, scale)
+            # create_mosaic writes its collage to the current directory
+            chdir(directory)
+            runs = []
+            for _ in range(repeats):
+                mosaic_creator = MosaicCreator(block_size=scale['block_size'], **creator_options)
+                runs.append(run_stages(mosaic_creator, main_image, micro_images))
+        finally:
+            chdir(working_directory)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        stages = {stage: min((run[stage] for run in runs), key=lambda timing: timing['wall']) for stage in STAGES}
+        results.append({'scale': scale_name, 'tile_count': scale['tile_count'], 'block_size': scale['block_size'],
+                        'main_size': list(scale['main_size']), 'repeats': repeats, 'stages': stages})
+        for stage in STAGES:
+            print("  %-14s %8.3fs wall %8.3fs cpu %8.3fs child cpu" % (
+                stage, stages[stage]['wall'], stages[stage]['cpu'], stages[stage]['child_cpu']))
+        print("  peak memory %d MB, estimated %d MB" % (stages['create_mosaic']['peak_rss'] // 2 ** 20,
+                                                       stages['create_mosaic']['estimated_peak_rss'] // 2 ** 20))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of MosaicCreator on synthetic workloads.")
+    parser.add_argument('--scales', nargs='+', default=['tiny', 'small'], choices=sorted(SCALES),
+                        help="Workloads to run")
+    parser.add_argument('--repeats', type=int, default=1, help="Runs per workload, the fastest is reported")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file to write results to")
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help="MosaicCreator keyword argument, VALUE is parsed as JSON if possible")
+    arguments = parser.parse_args()
+
+    creator_options = {}
+    for option in arguments.option:
+        name, value = option.split('=', 1)
+        try:
+            creator_options[name] = json.loads(value)
+        except ValueError:
+            creator_options[name] = value
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': Image.__version__,
+        'machine': platform.machine(),
+        'creator_options': creator_options,
+        'results': run_benchmark(arguments.scales, arguments.repeats, creator_options),
+    }
+    with open(arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print("Results written to", arguments.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,980 @@
 from tkinter import *
 from PIL import Image
 from os import *
+import argparse
+import hashlib
+import heapq
+import io
+import struct
+import sys
 import time
+import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import math
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Metrics accepted by MosaicCreator(metric=...)
+# absolute: sum of absolute red and green differences, the original get_pixel_difference behaviour
+# absolute_rgb: sum of absolute differences over all three channels
+# squared: sum of squared differences over all three channels
+# lab: sum of squared CIELAB differences (delta E 1976 squared), which follows perceived colour difference more closely
+MATCH_METRICS = ('absolute', 'absolute_rgb', 'squared', 'lab')
+# Metrics compared as a sum of squares, after any colour space conversion
+SQUARED_METRICS = ('squared', 'lab')
+
+# Linear light value of each 8-bit sRGB level, interpolated for segment averages between levels
+SRGB_TO_LINEAR = np.where(np.arange(256) / 255 <= 0.04045, np.arange(256) / 255 / 12.92,
+                          ((np.arange(256) / 255 + 0.055) / 1.055) ** 2.4)
+# Linear sRGB to CIE XYZ, with each row divided by the D65 white point so white is (1, 1, 1)
+LINEAR_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                          [0.2126729, 0.7151522, 0.0721750],
+                          [0.0193339, 0.1191920, 0.9503041]]) / np.array([[0.95047], [1.0], [1.08883]])
+
+# Rough upper bound on the size of the distance arrays built per chunk of blocks when match_chunk_size is not set
+# Kept small enough that a chunk's working set stays in cache
+MATCH_CHUNK_BYTES = 4 * 1024 * 1024
+# Number of micro-images compared per chunk of blocks
+MATCH_TILE_CHUNK = 2048
+
+# Rough sizes used by MosaicCreator.estimate_memory
+# Resident memory of a fresh ingest worker process, with NumPy and PIL imported
+WORKER_PROCESS_BYTES = 48 * 1024 * 1024
+# Typical JPEG size per pixel of a collage at PIL's default quality
+JPEG_BYTES_PER_PIXEL = 0.2
+
 
 class MosaicCreator:
-    def __init__(self, block_size=5, size_reduction_factor=1, alpha_adjustment=0.0):
+    def __init__(self, block_size=5, size_reduction_factor=1, alpha_adjustment=0.0, metric='absolute',
+                 match_chunk_size=None, tile_cache_path=None, match_index=None, match_epsilon=0.0,
+                 index_grid_levels=16, output_format=None, micro_image_cache_bytes=256 * 1024 * 1024,
+                 match_workers=None, ingest_workers=None, legacy_resize=False, metrics=None, match_candidates=None,
+                 match_exact=False, incremental=False, save_assignments=False, match_cache_step=None,
+                 match_cache_size=65536, max_tile_uses=None, min_repeat_distance=0, constraint_candidates=32,
+                 tile_atlas_path=None, pipeline=False, pipeline_depth=2, pipeline_band_rows=4, tile_side_limit=None):
         # -------------------
         # Adjust this value to change the resolution of the final image
         self.block_size = block_size
         self.size_reduction_factor = size_reduction_factor
         self.alpha_adjustment = max(0.0, min(1.0, alpha_adjustment))  # Range of 0-1
 
+        if metric not in MATCH_METRICS:
+            raise ValueError("metric must be one of " + ", ".join(MATCH_METRICS))
+        self.metric = metric
+        self.match_chunk_size = match_chunk_size  # Blocks per distance chunk, None = sized from MATCH_CHUNK_BYTES
+        self.match_workers = match_workers or cpu_count() or 1  # Threads used for matching, None = one per CPU
+        self.tile_cache_path = tile_cache_path  # .npz file of micro-image features reused between runs, None = off
+
+        # Set match_index to 'grid' to search a TileIndex instead of comparing every block to every micro-image
+        # match_epsilon = 0 is an exact search, otherwise matches are within (1 + match_epsilon) of the best difference
+        if match_index not in (None, 'grid'):
+            raise ValueError("match_index must be None or 'grid'")
+        self.match_index = match_index
+        self.match_epsilon = max(0.0, match_epsilon)
+        self.index_grid_levels = index_grid_levels  # Grid cells per colour channel
+
+        # Set match_candidates to rank micro-images by a 2x2 summary of each block first, and only fully compare the
+        # closest match_candidates of them. match_exact falls back to a full comparison for any block where the summary
+        # cannot prove the best candidate is the best overall
+        if match_candidates and match_index:
+            raise ValueError("match_candidates cannot be combined with match_index")
+        self.match_candidates = match_candidates
+        self.match_exact = match_exact
+
+        # Set match_cache_step to match each distinct block only once. Blocks whose prepared features are equal after
+        # dividing by match_cache_step and rounding down reuse the first match found, and larger steps merge more
+        # near-identical blocks. The 'absolute' and 'squared' features are whole RGB values, so there 1 only merges
+        # identical blocks and leaves matches unchanged. 'lab' features are fractional, so 1 already merges blocks less
+        # than one Lab unit apart, which can change matches. Up to match_cache_size matches are kept between collages
+        if match_cache_step is not None and match_cache_step <= 0:
+            raise ValueError("match_cache_step must be positive")
+        self.match_cache_step = match_cache_step
+        self.match_cache_size = match_cache_size
+
+        # Limit how often each micro-image is used (max_tile_uses) and how close together the same micro-image may be
+        # placed (min_repeat_distance, in blocks, 2 or more stops identical micro-images touching). When either is set,
+        # find_closest_tiles assigns micro-images with a ConstrainedAssigner, which tries each block's
+        # constraint_candidates closest micro-images before searching all of them. None tries all of them up front
+        if incremental and (max_tile_uses or min_repeat_distance > 1):
+            raise ValueError("max_tile_uses and min_repeat_distance cannot be combined with incremental")
+        self.max_tile_uses = max_tile_uses
+        self.min_repeat_distance = min_repeat_distance
+        self.constraint_candidates = constraint_candidates
+
+        # Set pipeline to overlap the stages of a collage rather than run them one after another: micro-images are
+        # decoded while earlier ones are measured, bands of pipeline_band_rows rows of blocks are matched while earlier
+        # rows are rendered, and rendered rows are written while later ones are rendered. Each stage runs at most
+        # pipeline_depth items ahead of the next, which bounds the memory held between stages
+        if pipeline and (incremental or max_tile_uses or min_repeat_distance > 1):
+            raise ValueError("pipeline cannot be combined with incremental, max_tile_uses or min_repeat_distance")
+        self.pipeline = pipeline
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.pipeline_band_rows = max(1, pipeline_band_rows)
+        # Largest micro-image side length to use, on top of the limit from get_max_tile_side. Usually chosen by
+        # plan_job to fit a memory budget. None = no extra limit
+        self.tile_side_limit = tile_side_limit
+
+        # 'jpg' builds the whole collage in memory, 'tiff' writes it one row of micro-images at a time, so the collage
+        # is not limited by PIL's maximum image size or by available memory. 'dzi' streams the rows the same way into a
+        # Deep Zoom tile pyramid, for zoomable viewers. None = 'tiff' when incremental, as a JPEG would have to be
+        # decoded and encoded again in full, losing quality, for every edit, otherwise 'jpg'
+        if output_format is None:
+            output_format = 'tiff' if incremental else 'jpg'
+        if output_format not in ('jpg', 'tiff', 'dzi'):
+            raise ValueError("output_format must be 'jpg', 'tiff' or 'dzi'")
+        if incremental and output_format == 'jpg':
+            raise ValueError("incremental needs output_format 'tiff' or 'dzi'")
+        self.output_format = output_format
+        self.micro_image_cache_bytes = micro_image_cache_bytes  # Memory for resized micro-images while pasting
+        # .npy file of every resized micro-image to paste from, memory-mapped and shared by any worker processes rather
+        # than each one decoding micro-images into a MicroImageCache. None = off
+        self.tile_atlas_path = tile_atlas_path
+        self.ingest_workers = ingest_workers or cpu_count() or 1  # Processes decoding micro-images, None = one per CPU
+        # Resize micro-images through every step of resize_images rather than a single crop and resize, to reproduce
+        # collages made before the single step resize was added
+        self.legacy_resize = legacy_resize
+        self.metrics = metrics or MosaicMetrics()  # Timings and counters for each stage of create_mosaic
+        # Save the block colours and chosen micro-images next to each collage, so that remaking it after an edit to
+        # the main image only re-matches and repaints the blocks which changed
+        self.incremental = incremental
+        # Save the AssignmentGrid of each collage as <collage>.assignment.npz, so it can be rendered again later
+        self.save_assignments = save_assignments
+
         self.image_width = None
         self.image_height = None
         self.micro_block_size = 0
+        self.prepared_tiles = None  # Matching data for the last micro-images matched against, reused between collages
+        self.match_cache = None  # MatchCache, created when first needed if match_cache_step is set
 
-    def create_mosaic(self, micro_images, main_image):
-        # Open image files
-        opened_images = self.open_images(micro_images)
-        main_image = Image.open(main_image)
+    def __getstate__(self):
+        # Sent to worker processes, which keep their own metrics and do not need the matching data
+        state = dict(self.__dict__)
+        state['metrics'] = MosaicMetrics()
+        state['prepared_tiles'] = None
+        state['match_cache'] = None
+        return state
+
+    def create_mosaic(self, micro_images, main_image, output_path=None):
+        """
+        Makes a collage of one main image out of the micro-images.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param main_image: Path to the main image.
+        :param output_path: Path to save the collage to. Defaults to Updated_Collage.jpg, or .tif for TIFF output.
+        """
 
-        # Resize images based on dimensions of small and large images
+        main_image = Image.open(main_image)
         self.image_width, self.image_height = main_image.size
-        smallest_image, opened_images = self.resize_images(opened_images)
+
+        # Get the colours of each micro-image, resized based on dimensions of small and large images
+        # Only the colours are kept, the micro-images themselves are loaded again when pasted
+        with self.metrics.span('micro_image_features'):
+            tile_side, blocked_micro_images = self.load_micro_image_blocks(micro_images)
+        loaded_images = self.get_tile_loader([image for image, _ in blocked_micro_images], tile_side)
+
+        self.make_collage(main_image, tile_side, blocked_micro_images, output_path or self.get_default_output_path(),
+                          loaded_images)
+
+    def create_mosaics(self, micro_images, main_images, output_folder):
+        """
+        Makes a collage of each main image, reusing the same micro-images for all of them.
+        The micro-images are measured once, at a size that suits every main image, and loaded micro-images are shared
+        between collages.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param main_images: Array of paths to the main images.
+        :param output_folder: Folder to save the collages to, each named after its main image.
+        :return: Array of the paths of the saved collages.
+        """
+
+        tile_side, blocked_micro_images, loaded_images = self.load_shared_micro_images(micro_images, main_images)
+
+        output_paths = self.get_batch_output_paths(main_images, output_folder)
+        for main_image, output_path in zip(main_images, output_paths):
+            print("Creating collage of", main_image)
+            image = Image.open(main_image)
+            self.image_width, self.image_height = image.size
+            with self.metrics.span('collage'):
+                self.make_collage(image, tile_side, blocked_micro_images, output_path, loaded_images)
+        return output_paths
+
+    def create_frame_mosaics(self, micro_images, frames, output_folder, change_threshold=4.0):
+        """
+        Makes a collage of each frame of a sequence, such as the frames of a video.
+        Each block is only matched again if its colours have changed by more than change_threshold since it was last
+        matched, otherwise it keeps the same micro-image. Mostly static footage is then much quicker to match, and the
+        micro-images do not flicker between similar choices from frame to frame.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param frames: Array of paths to the frames, in order.
+        :param output_folder: Folder to save the collages to, each named after its frame.
+        :param change_threshold: Average difference per pixel and colour channel, from 0 to 255, above which a block
+                                 is matched again. 0 matches every block that changes at all.
+        :return: Array of the paths of the saved collages.
+        """
+
+        if self.max_tile_uses or self.min_repeat_distance > 1:
+            raise ValueError("max_tile_uses and min_repeat_distance cannot be used for frame sequences")
+        tile_side, blocked_micro_images, loaded_images = self.load_shared_micro_images(micro_images, frames)
+
+        reference_blocks = None
+        matches = None
+        output_paths = self.get_batch_output_paths(frames, output_folder)
+        for frame, output_path in zip(frames, output_paths):
+            print("Creating collage of", frame)
+            image = Image.open(frame)
+            self.image_width, self.image_height = image.size
+            with self.metrics.span('collage'):
+                with self.metrics.span('main_image'):
+                    colour_array = self.get_pixel_array(image)
+                    block_features, grid_shape = self.get_block_features(colour_array)
+
+                with self.metrics.span('matching'):
+                    if reference_blocks is None or reference_blocks.shape != block_features.shape:
+                        changed = np.ones(len(block_features), dtype=bool)
+                        reference_blocks = np.array(block_features)
+                        matches = np.empty(len(block_features), dtype=np.intp)
+                    else:
+                        difference = np.abs(block_features.astype(np.int16) - reference_blocks)
+                        changed = difference.mean(axis=(1, 2)) > change_threshold
+                    print("Matching", int(changed.sum()), "of", len(changed), "blocks")
+                    self.metrics.count('blocks_matched', int(changed.sum()))
+                    self.metrics.count('blocks_reused', int(len(changed) - changed.sum()))
+
+                    if changed.any():
+                        tile_features, tile_index = self.prepare_tiles(blocked_micro_images)
+                        matches[changed] = self.match_features(self.prepare_features(block_features[changed]),
+                                                               tile_features, tile_index)
+                        # Compare against the colours the block was matched with, so slow drifts are still caught
+                        reference_blocks[changed] = block_features[changed]
+                    image_array = self.get_image_array(matches.reshape(grid_shape), blocked_micro_images)
+
+                self.save_collage(image_array, tile_side, output_path, loaded_images, colour_array)
+        return output_paths
+
+    def load_shared_micro_images(self, micro_images, main_images):
+        """
+        Loads the micro-images once for a batch of main images, at a side length that suits all of them.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param main_images: Array of paths to the main images.
+        :return: The micro-image side length, the output of load_micro_image_blocks and a MicroImageCache or TileAtlas
+                 to share.
+        """
+
+        max_tile_side = math.inf
+        for main_image in main_images:
+            self.image_width, self.image_height = Image.open(main_image).size
+            max_tile_side = min(max_tile_side, self.get_max_tile_side())
+
+        with self.metrics.span('micro_image_features'):
+            tile_side, blocked_micro_images = self.load_micro_image_blocks(micro_images, max_tile_side)
+        loaded_images = self.get_tile_loader([image for image, _ in blocked_micro_images], tile_side)
+        return tile_side, blocked_micro_images, loaded_images
+
+    def get_tile_loader(self, micro_images, tile_side):
+        """
+        :param micro_images: Array of paths to the micro-images that will be pasted.
+        :param tile_side: Side length of every micro-image in the collage.
+        :return: The TileAtlas at self.tile_atlas_path, built first if it is out of date, or a new MicroImageCache if
+                 there is no atlas.
+        """
+
+        if self.tile_atlas_path:
+            with self.metrics.span('tile_atlas'):
+                return self.build_tile_atlas(micro_images, tile_side, self.tile_atlas_path)
+        return MicroImageCache(self, tile_side)
+
+    def build_tile_atlas(self, micro_images, tile_side, atlas_path):
+        """
+        Resizes every micro-image into a single (number of micro-images, tile_side, tile_side, 3) uint8 array saved
+        as a .npy file, with a description of what it holds saved next to it as <atlas_path>.json.
+        If the atlas already holds these micro-images at this size, and none have changed since, it is reused as is.
+        The atlas is written to a temporary file and moved into place once complete, so workers reading it never see
+        a partial atlas.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param atlas_path: Path of the .npy file.
+        :return: The TileAtlas.
+        """
+
+        image_paths = [path.abspath(image) for image in micro_images]
+        image_stats = [stat(image_path) for image_path in image_paths]
+        description = {'tile_side': tile_side, 'legacy_resize': self.legacy_resize, 'paths': image_paths,
+                       'mtimes': [image_stat.st_mtime for image_stat in image_stats],
+                       'sizes': [image_stat.st_size for image_stat in image_stats]}
+
+        description_path = atlas_path + ".json"
+        if path.exists(atlas_path) and path.exists(description_path):
+            with io.open(description_path) as description_file:
+                if json.load(description_file) == description:
+                    print("Reusing tile atlas", atlas_path)
+                    return TileAtlas(atlas_path)
+            remove(description_path)
+
+        print("Building tile atlas of", len(image_paths), "micro-images")
+        temp_path = atlas_path + ".tmp.npy"
+        tiles = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8,
+                                          shape=(len(image_paths), tile_side, tile_side, 3))
+        if self.ingest_workers > 1 and len(image_paths) > self.ingest_workers:
+            chunk_size = max(1, len(image_paths) // (self.ingest_workers * 4))
+            with ProcessPoolExecutor(max_workers=self.ingest_workers) as executor:
+                for index, pixels in enumerate(executor.map(self.get_micro_image_pixels, image_paths,
+                                                            [tile_side] * len(image_paths), chunksize=chunk_size)):
+                    tiles[index] = pixels
+        else:
+            for index, image_path in enumerate(image_paths):
+                tiles[index] = self.get_micro_image_pixels(image_path, tile_side)
+        self.metrics.count('micro_images_decoded_for_atlas', len(image_paths))
+        tiles.flush()
+        del tiles
+        replace(temp_path, atlas_path)
+
+        with io.open(description_path + ".tmp", 'w') as description_file:
+            json.dump(description, description_file)
+        replace(description_path + ".tmp", description_path)
+        return TileAtlas(atlas_path)
+
+    def get_micro_image_pixels(self, image_path, tile_side):
+        """
+        :param image_path: Path to a micro-image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :return: The resized micro-image as a tile_side x tile_side x 3 uint8 array.
+        """
+
+        return self.get_pixel_array(self.prepare_micro_image(image_path, tile_side))
+
+    def get_batch_output_paths(self, main_images, output_folder):
+        """
+        Names a collage after each main image. Main images in different folders keep their folders relative to the
+        folder they all share, so that two with the same name do not overwrite each other's collage.
+
+        :param main_images: Array of paths to the main images.
+        :param output_folder: Folder collages are saved to.
+        :return: Array of the paths to save each main image's collage to.
+        """
+
+        extension = path.splitext(self.get_default_output_path())[1]
+        main_images = [path.abspath(main_image) for main_image in main_images]
+        shared_folder = path.commonpath([path.dirname(main_image) for main_image in main_images]) if main_images else ""
+        output_paths = []
+        for main_image in main_images:
+            relative_path = path.relpath(main_image, shared_folder)
+            output_path = path.join(output_folder, path.splitext(relative_path)[0] + "_collage" + extension)
+            if output_path in output_paths:
+                raise ValueError("%s and %s would both be saved to %s" % (
+                    main_images[output_paths.index(output_path)], main_image, output_path))
+            output_paths.append(output_path)
+        for output_path in output_paths:
+            makedirs(path.dirname(output_path) or ".", exist_ok=True)
+        return output_paths
+
+    def get_default_output_path(self):
+        """
+        :return: The path collages are saved to when no path is given.
+        """
+
+        extensions = {'jpg': ".jpg", 'tiff': ".tif", 'dzi': ".dzi"}
+        return "Updated_Collage" + extensions[self.output_format]
+
+    def make_collage(self, main_image, tile_side, blocked_micro_images, output_path, loaded_images=None):
+        """
+        Matches the blocks of an opened main image to the micro-images, then saves the collage.
+
+        :param main_image: The opened main image. self.image_width and self.image_height must match it.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param blocked_micro_images: Output of load_micro_image_blocks.
+        :param output_path: Path to save the collage to.
+        :param loaded_images: A MicroImageCache to share between collages, or None for a new one.
+        """
 
         # Divide the large image into segments and find which micro image best matches each segment
         print("Getting pixel colours of main image")
-        colour_array = self.get_pixel_colours(main_image)
-        blocked_micro_images = self.get_micro_image_blocks(opened_images)
-        image_array = self.find_closest_image(colour_array, blocked_micro_images)
+        with self.metrics.span('main_image'):
+            colour_array = self.get_pixel_array(main_image)
+        if self.incremental:
+            self.update_collage(colour_array, tile_side, blocked_micro_images, output_path, loaded_images)
+            return
+        if self.pipeline:
+            with self.metrics.span('pipeline'):
+                self.pipeline_collage(colour_array, tile_side, blocked_micro_images, output_path, loaded_images)
+            return
+
+        with self.metrics.span('matching'):
+            assignment = self.find_closest_tiles(colour_array, blocked_micro_images, tile_side)
+        if self.save_assignments:
+            assignment.save(output_path + ".assignment.npz")
+        self.save_collage(assignment.get_image_array(), tile_side, output_path, loaded_images, colour_array)
+
+    def pipeline_collage(self, colour_array, tile_side, blocked_micro_images, output_path, loaded_images=None):
+        """
+        Matches, renders and saves a collage with the three stages overlapped. Matching runs in one thread, a band of
+        self.pipeline_band_rows rows of blocks at a time, rendering in another, and writing in this one. Each waits for
+        the one before when it runs out of work, and each is held back once it is self.pipeline_depth items ahead.
+        A JPEG cannot be encoded in pieces, so for JPEG output rows are rendered straight into the collage and it is
+        encoded once complete.
+
+        :param colour_array: The main image as an HxWx3 array of RGB values.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param blocked_micro_images: Output of load_micro_image_blocks.
+        :param output_path: Path to save the collage to.
+        :param loaded_images: A MicroImageCache or TileAtlas to share between collages, or None for a new cache.
+        """
+
+        print("Matching, rendering and saving the collage in a pipeline")
+        block_features, grid_shape = self.get_block_features(colour_array)
+        self.metrics.count('blocks_matched', len(block_features))
+        tile_features, tile_index = self.prepare_tiles(blocked_micro_images)
+        manifest = [image for image, _ in blocked_micro_images]
+        rows, columns = grid_shape
+        matches = np.empty(grid_shape, dtype=np.intp)
+        loaded_images = loaded_images or MicroImageCache(self, tile_side)
+
+        def match_bands():
+            for start in range(0, rows, self.pipeline_band_rows):
+                end = min(start + self.pipeline_band_rows, rows)
+                band_features = self.prepare_features(block_features[start * columns:end * columns])
+                matches[start:end] = self.match_features(band_features, tile_features, tile_index).reshape(-1, columns)
+                yield start, end
+
+        def matched_rows():
+            for start, end in self.run_ahead(match_bands(), 'matching'):
+                for row in range(start, end):
+                    yield row, [manifest[index] for index in matches[row]]
+
+        def render_rows(canvas=None):
+            for row, images in matched_rows():
+                band = None if canvas is None else canvas[row * tile_side:(row + 1) * tile_side, :columns * tile_side]
+                yield self.get_collage_band(images, tile_side, loaded_images,
+                                            self.get_colour_rows(colour_array, row, columns), band)
+
+        if self.output_format in ('tiff', 'dzi'):
+            print("Writing collage to", output_path)
+            writer_class = DeepZoomWriter if self.output_format == 'dzi' else TiffStripWriter
+            with writer_class(output_path, columns * tile_side, rows * tile_side) as writer:
+                for band in self.run_ahead(render_rows(), 'rendering'):
+                    writer.write_strip(band)
+        else:
+            width_ratio = height_ratio = int(tile_side / self.block_size)
+            canvas = np.zeros((max(self.image_height * height_ratio, rows * tile_side),
+                               max(self.image_width * width_ratio, columns * tile_side), 3), dtype=np.uint8)
+            for _ in render_rows(canvas):
+                pass
+            with self.metrics.span('encode'):
+                Image.fromarray(canvas).save(output_path)
+        print("Loaded", loaded_images.misses, "micro-images for pasting,", loaded_images.hits, "reused")
+
+        if self.save_assignments:
+            AssignmentGrid(matches, manifest, self.block_size, (colour_array.shape[1], colour_array.shape[0]),
+                           tile_side, self.get_assignment_colours(colour_array, grid_shape)).save(
+                output_path + ".assignment.npz")
+
+    def run_ahead(self, items, stage):
+        """
+        Runs an iterator in a separate thread, up to self.pipeline_depth items ahead of whatever consumes it.
+        The time the consumer spends waiting for items is counted in self.metrics as pipeline_<stage>_wait, to show
+        which stage holds the pipeline back. Any exception in the thread is raised to the consumer.
+
+        :param items: The iterator, usually a generator.
+        :param stage: Name of the stage the iterator runs, for the wait counter.
+        :return: A generator of the same items.
+        """
+
+        produced = queue.Queue(maxsize=self.pipeline_depth)
+        finished = object()
+        stopped = threading.Event()
+
+        def put(item):
+            # Gives up if the consumer has stopped, rather than blocking on a full queue forever
+            while not stopped.is_set():
+                try:
+                    produced.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+            finally:
+                put(finished)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(produce)
+        try:
+            while True:
+                wait = time.perf_counter()
+                item = produced.get()
+                self.metrics.count('pipeline_%s_wait' % stage, time.perf_counter() - wait)
+                if item is finished:
+                    break
+                yield item
+            future.result()
+        finally:
+            stopped.set()
+            executor.shutdown()
+
+    def render_assignment(self, assignment, output_path, tile_side=None):
+        """
+        Renders a collage from a saved AssignmentGrid, without matching again.
+
+        :param assignment: An AssignmentGrid, or the path of one saved with AssignmentGrid.save.
+        :param output_path: Path to save the collage to.
+        :param tile_side: Side length of the micro-images in the collage. Defaults to the side length the assignment
+                          was matched at, but can be changed to render at a different resolution.
+        """
+
+        if not isinstance(assignment, AssignmentGrid):
+            assignment = AssignmentGrid.load(assignment)
+        self.check_assignment_colours(assignment)
+        tile_side = tile_side or assignment.tile_side
+        self.image_width, self.image_height = assignment.main_size
+        self.save_collage(assignment.get_image_array(), tile_side, output_path,
+                          self.get_tile_loader(assignment.manifest, tile_side), assignment.colours)
+
+    def render_regions(self, assignment, output_folder, tile_side=None, region_size=16, workers=None, executor=None,
+                       stitch_path=None):
+        """
+        Renders a collage from an AssignmentGrid as separate rectangular regions, each rendered by a worker.
+        Workers are local processes by default. Any executor with the concurrent.futures submit interface can be given
+        instead, for example one that runs tasks on other hosts, as long as they share a filesystem with output_folder
+        and the micro-images.
+        If self.tile_atlas_path is set, the atlas is built before any region is rendered and every worker pastes from
+        it, so each micro-image is decoded once rather than once per worker.
+        The regions are kept as a tiled set of TIFFs described by regions.json in output_folder, and optionally
+        stitched into a single TIFF or Deep Zoom pyramid.
+
+        :param assignment: An AssignmentGrid, or the path of one saved with AssignmentGrid.save.
+        :param output_folder: Shared folder to write the regions to.
+        :param tile_side: Side length of the micro-images. Defaults to the side length the assignment was matched at.
+        :param region_size: Width and height of each region, in micro-images.
+        :param workers: Number of local worker processes, if no executor is given. Defaults to one per CPU.
+        :param executor: Executor to run the region renders on, instead of local processes.
+        :param stitch_path: Path to stitch the regions into a single collage at, or None to only keep the regions.
+        :return: The region index, as saved to regions.json.
+        """
+
+        if stitch_path:
+            self.get_stitch_writer_class(stitch_path)
+        makedirs(output_folder, exist_ok=True)
+        if isinstance(assignment, AssignmentGrid):
+            assignment_path = path.join(output_folder, "assignment.npz")
+            assignment.save(assignment_path)
+        else:
+            assignment_path = assignment
+            assignment = AssignmentGrid.load(assignment_path)
+        self.check_assignment_colours(assignment)
+        tile_side = tile_side or assignment.tile_side
+        rows, columns = assignment.tile_ids.shape
+        if self.tile_atlas_path:
+            with self.metrics.span('tile_atlas'):
+                self.build_tile_atlas(assignment.manifest, tile_side, self.tile_atlas_path)
+
+        regions = []
+        for row in range(0, rows, region_size):
+            for column in range(0, columns, region_size):
+                region = (row, min(row + region_size, rows), column, min(column + region_size, columns))
+                regions.append((region, path.join(output_folder, "region_%05d_%05d.tif" % (row, column))))
+
+        print("Rendering", len(regions), "regions")
+        with self.metrics.span('render_regions'):
+            local_executor = None
+            if executor is None:
+                local_executor = executor = ProcessPoolExecutor(max_workers=workers or cpu_count() or 1)
+            try:
+                futures = [executor.submit(self.render_region, assignment_path, region, tile_side, region_path)
+                           for region, region_path in regions]
+                for future in futures:
+                    future.result()
+            finally:
+                if local_executor is not None:
+                    local_executor.shutdown()
+
+        index = {'tile_side': tile_side, 'width': columns * tile_side, 'height': rows * tile_side,
+                 'regions': [{'rows': [region[0], region[1]], 'columns': [region[2], region[3]],
+                              'x': region[2] * tile_side, 'y': region[0] * tile_side,
+                              'path': path.basename(region_path)} for region, region_path in regions]}
+        with io.open(path.join(output_folder, "regions.json"), 'w') as index_file:
+            json.dump(index, index_file, indent=2)
+
+        if stitch_path:
+            with self.metrics.span('stitch_regions'):
+                self.stitch_regions(output_folder, stitch_path)
+        return index
+
+    def render_region(self, assignment_path, region, tile_side, region_path):
+        """
+        Renders one region of a saved AssignmentGrid to a TIFF. Run by the workers of render_regions.
+
+        :param assignment_path: Path of the saved AssignmentGrid.
+        :param region: (first row, end row, first column, end column) of the region, in micro-images.
+        :param tile_side: Side length of the micro-images.
+        :param region_path: Path of the TIFF to write.
+        :return: region_path.
+        """
+
+        # Only this region of the memory-mapped micro-image numbers and colours is read
+        assignment = AssignmentGrid.load(assignment_path)
+        first_row, end_row, first_column, end_column = region
+        image_array = assignment.get_image_array(region)
+        colour_array = None
+        if assignment.colours is not None:
+            colour_array = assignment.colours[first_row * self.block_size:end_row * self.block_size,
+                                              first_column * self.block_size:end_column * self.block_size]
+        # The atlas was already built by render_regions, so it is only opened here
+        loaded_images = TileAtlas(self.tile_atlas_path) if self.tile_atlas_path else None
+        self.stream_collage(image_array, tile_side, region_path, loaded_images, writer_class=TiffStripWriter,
+                            colour_array=colour_array)
+        return region_path
+
+    def stitch_regions(self, region_folder, output_path):
+        """
+        Joins the regions written by render_regions into a single TIFF, or a Deep Zoom pyramid if self.output_format
+        is 'dzi', one row of regions at a time.
+
+        :param region_folder: Folder containing regions.json and the region TIFFs.
+        :param output_path: Path of the .tif or .tiff file, or .dzi file for Deep Zoom, to write.
+        """
+
+        with io.open(path.join(region_folder, "regions.json")) as index_file:
+            index = json.load(index_file)
+        tile_side = index['tile_side']
+
+        bands = OrderedDict()
+        for region in index['regions']:
+            bands.setdefault(region['y'], []).append(region)
+
+        print("Stitching regions into", output_path)
+        writer_class = self.get_stitch_writer_class(output_path)
+        with writer_class(output_path, index['width'], index['height']) as writer:
+            for band_regions in bands.values():
+                band = None
+                for region in band_regions:
+                    with Image.open(path.join(region_folder, region['path'])) as region_image:
+                        pixels = self.get_pixel_array(region_image)
+                    if band is None:
+                        band = np.empty((pixels.shape[0], index['width'], 3), dtype=np.uint8)
+                    band[:, region['x']:region['x'] + pixels.shape[1]] = pixels
+                for strip_start in range(0, band.shape[0], tile_side):
+                    writer.write_strip(band[strip_start:strip_start + tile_side])
+
+    def get_stitch_writer_class(self, output_path):
+        """
+        Regions are always stitched into a TIFF, or a Deep Zoom pyramid if self.output_format is 'dzi', never a JPEG.
+
+        :param output_path: Path to stitch regions into, which must end in .tif or .tiff, or .dzi for Deep Zoom.
+        :return: TiffStripWriter or DeepZoomWriter.
+        """
+
+        if self.output_format == 'dzi':
+            writer_class, extensions = DeepZoomWriter, ('.dzi',)
+        else:
+            writer_class, extensions = TiffStripWriter, ('.tif', '.tiff')
+        if path.splitext(output_path)[1].lower() not in extensions:
+            raise ValueError("Regions are stitched into a %s, so %s must end in %s"
+                             % ("Deep Zoom pyramid" if self.output_format == 'dzi' else "TIFF", output_path,
+                                " or ".join(extensions)))
+        return writer_class
+
+    def update_collage(self, colour_array, tile_side, blocked_micro_images, output_path, loaded_images=None):
+        """
+        Makes a collage incrementally. If the collage was previously made with the same settings and micro-images,
+        only blocks of the main image which have changed since are matched again and repainted into the existing
+        collage. Otherwise the whole collage is made and the state for the next update is saved.
+        TIFF collages are repainted in place, so the time taken is proportional to the edited area. Deep Zoom pyramids
+        are written again, but are still not re-matched.
+
+        :param colour_array: The main image as an HxWx3 array of RGB values.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param blocked_micro_images: Output of load_micro_image_blocks.
+        :param output_path: Path to save the collage to.
+        :param loaded_images: A MicroImageCache to share between collages, or None for a new one.
+        """
 
-        # Create new blank image with dimensions to fit all images in collage
-        # Image.new cannot handle any width/height higher than ~100,000px
+        state_path = output_path + ".mosaic_state.npz"
+        with self.metrics.span('matching'):
+            block_features, grid_shape = self.get_block_features(colour_array)
+            tile_features, tile_index = self.prepare_tiles(blocked_micro_images)
+            fingerprint = self.get_collage_fingerprint(tile_features, blocked_micro_images, tile_side, grid_shape)
+
+            state = self.read_collage_state(state_path)
+            if state is not None and state['fingerprint'] == fingerprint and path.exists(output_path):
+                changed = (block_features != state['blocks']).any(axis=(1, 2))
+                matches = state['matches']
+            else:
+                state = None
+                changed = np.ones(len(block_features), dtype=bool)
+                matches = np.empty(len(block_features), dtype=np.intp)
+
+            print("Matching", int(changed.sum()), "of", len(changed), "blocks")
+            self.metrics.count('blocks_matched', int(changed.sum()))
+            if changed.any():
+                matches[changed] = self.match_features(self.prepare_features(block_features[changed]),
+                                                       tile_features, tile_index)
+            image_array = self.get_image_array(matches.reshape(grid_shape), blocked_micro_images)
+
+        if state is None:
+            self.save_collage(image_array, tile_side, output_path, loaded_images, colour_array)
+        elif changed.any():
+            with self.metrics.span('repaint'):
+                self.repaint_collage(image_array, tile_side, output_path, changed.reshape(grid_shape), loaded_images,
+                                     colour_array)
+        np.savez(state_path, fingerprint=fingerprint, blocks=block_features, matches=matches)
+
+    def get_collage_fingerprint(self, tile_features, micro_images, tile_side, grid_shape):
+        """
+        Identifies everything other than the main image that a saved collage depends on.
+
+        :param tile_features: Prepared micro-image features.
+        :param micro_images: Output of load_micro_image_blocks.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param grid_shape: Rows and columns of blocks in the main image.
+        :return: A hex digest.
+        """
+
+        fingerprint = hashlib.sha1()
+        settings = (self.block_size, self.metric, self.output_format, self.legacy_resize, self.match_index,
+                    self.match_epsilon, self.match_candidates, self.match_exact, tile_side, grid_shape,
+                    self.image_width, self.image_height, self.alpha_adjustment, self.match_cache_step)
+        fingerprint.update(repr(settings).encode())
+        for image, _ in micro_images:
+            fingerprint.update(str(image).encode() + b'\0')
+        fingerprint.update(tile_features)
+        return fingerprint.hexdigest()
+
+    def read_collage_state(self, state_path):
+        """
+        :param state_path: Path of the state saved by update_collage.
+        :return: A dictionary of the saved fingerprint, block colours and matches, or None if there is none.
+        """
+
+        if not path.exists(state_path):
+            return None
+        with np.load(state_path) as state:
+            return {'fingerprint': str(state['fingerprint']), 'blocks': state['blocks'], 'matches': state['matches']}
+
+    def repaint_collage(self, image_array, tile_side, output_path, changed, loaded_images=None, colour_array=None):
+        """
+        Pastes new micro-images over the changed blocks of an existing collage.
+
+        :param image_array: Output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param output_path: Path of the existing collage.
+        :param changed: A rows x columns boolean array of the blocks to repaint.
+        :param loaded_images: A MicroImageCache to share between collages, or None for a new one.
+        :param colour_array: The main image as an HxWx3 array, to blend micro-images toward. See blend_band.
+        """
+
+        loaded_images = loaded_images or MicroImageCache(self, tile_side)
+        positions = list(zip(*np.nonzero(changed)))
+        self.metrics.count('blocks_repainted', len(positions))
+        print("Repainting", len(positions), "blocks of", output_path)
+
+        if self.output_format == 'dzi':
+            # Every zoom level above a changed block changes too, so the pyramid is written again
+            self.save_collage(image_array, tile_side, output_path, loaded_images, colour_array)
+            return
+
+        def get_tile_pixels(row, column):
+            colour_rows = None
+            if colour_array is not None:
+                colour_rows = colour_array[row * self.block_size:(row + 1) * self.block_size,
+                                           column * self.block_size:(column + 1) * self.block_size]
+            return self.get_collage_band([image_array[row][column]], tile_side, loaded_images, colour_rows)
+
+        # Uncompressed TIFF rows can be overwritten in place
+        with Image.open(output_path) as tiff:
+            strip_offsets = tiff.tag_v2[273]
+            rows_per_strip = tiff.tag_v2[278]
+            output_width = tiff.width
+        with io.open(output_path, 'r+b') as collage:
+            for row, column in positions:
+                pixels = get_tile_pixels(row, column)
+                for pixel_row in range(tile_side):
+                    y = row * tile_side + pixel_row
+                    collage.seek(strip_offsets[y // rows_per_strip] +
+                                 ((y % rows_per_strip) * output_width + column * tile_side) * 3)
+                    collage.write(pixels[pixel_row].tobytes())
+
+    def save_collage(self, image_array, tile_side, output_path, loaded_images=None, colour_array=None):
+        """
+        Saves the collage in self.output_format.
+
+        :param image_array: Output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param output_path: Path to save the collage to.
+        :param loaded_images: A MicroImageCache to share between collages, or None for a new one.
+        :param colour_array: The main image as an HxWx3 array, to blend micro-images toward. See blend_band.
+        """
+
+        if self.output_format in ('tiff', 'dzi'):
+            with self.metrics.span('stream_output'):
+                self.stream_collage(image_array, tile_side, output_path, loaded_images, colour_array=colour_array)
+            return
+
+        with self.metrics.span('paste'):
+            collage = self.assemble_collage(image_array, tile_side, loaded_images, colour_array)
+        with self.metrics.span('encode'):
+            Image.fromarray(collage).save(output_path)
+
+    def paste_collage(self, image_array, tile_side, loaded_images=None, colour_array=None):
+        """
+        Pastes the micro-images into a single collage image.
+
+        :param image_array: Output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param loaded_images: A MicroImageCache or TileAtlas to share between collages, or None for a new cache.
+        :param colour_array: The main image as an HxWx3 array, to blend micro-images toward. See blend_band.
+        :return: The collage image.
+        """
+
+        return Image.fromarray(self.assemble_collage(image_array, tile_side, loaded_images, colour_array))
+
+    def assemble_collage(self, image_array, tile_side, loaded_images=None, colour_array=None):
+        """
+        Places the micro-images into a single collage, as an array. Each row of micro-images is copied into the
+        canvas in bulk by get_collage_band, rather than pasted one at a time through PIL, and the collage only needs
+        converting to an image when it is encoded.
+
+        :param image_array: Output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param loaded_images: A MicroImageCache or TileAtlas to share between collages, or None for a new cache.
+        :param colour_array: The main image as an HxWx3 array, to blend micro-images toward. See blend_band.
+        :return: The collage, as a height x width x 3 uint8 array.
+        """
+
+        # Create new blank canvas with dimensions to fit all images in collage
+        # PIL cannot encode any width/height higher than ~100,000px
         print("Creating blank canvas")
-        mini_image_width, mini_image_height = smallest_image.size
+        mini_image_width = mini_image_height = tile_side
         width_ratio = int(mini_image_width / self.block_size)
         height_ratio = int(mini_image_height / self.block_size)
 
-        output_height = self.image_width * width_ratio
-        output_width = self.image_height * height_ratio
-        new_im = Image.new('RGB', (output_height, output_width))
+        # At least as big as the grid of micro-images, for micro-images not a multiple of the block size
+        output_height = max(self.image_width * width_ratio, len(image_array[0]) * mini_image_width)
+        output_width = max(self.image_height * height_ratio, len(image_array) * mini_image_height)
+        canvas = np.zeros((output_width, output_height, 3), dtype=np.uint8)
 
-        # Paste images into collage
+        # Copy images into collage
         print("Pasting images into collage")
+        loaded_images = loaded_images or MicroImageCache(self, tile_side)
         for index, row in enumerate(image_array):
-            for column_index, image in enumerate(row):
-                new_im.paste(image, (column_index * mini_image_width, index * mini_image_height))
-        new_im.save("Updated_Collage.jpg")
+            colour_rows = None
+            if colour_array is not None:
+                colour_rows = self.get_colour_rows(colour_array, index, len(row))
+            band = canvas[index * mini_image_height:(index + 1) * mini_image_height, :len(row) * mini_image_width]
+            self.get_collage_band(row, tile_side, loaded_images, colour_rows, band)
+        print("Loaded", loaded_images.misses, "micro-images for pasting,", loaded_images.hits, "reused")
+        return canvas
+
+    def stream_collage(self, image_array, tile_side, output_path, loaded_images=None, writer_class=None,
+                       colour_array=None):
+        """
+        Writes the collage to an uncompressed TIFF, or a Deep Zoom pyramid if self.output_format is 'dzi', one row of
+        micro-images per strip.
+        Only one row of the collage is held in memory at a time.
+
+        :param image_array: Output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param output_path: Path of the TIFF or .dzi file to write.
+        :param loaded_images: A MicroImageCache to share between collages, or None for a new one.
+        :param writer_class: TiffStripWriter or DeepZoomWriter, to override the one chosen by self.output_format.
+        :param colour_array: The main image as an HxWx3 array, to blend micro-images toward. See blend_band.
+        """
+
+        print("Writing collage to", output_path)
+        output_width = len(image_array[0]) * tile_side
+        output_height = len(image_array) * tile_side
+        loaded_images = loaded_images or MicroImageCache(self, tile_side)
+        writer_class = writer_class or (DeepZoomWriter if self.output_format == 'dzi' else TiffStripWriter)
+        with writer_class(output_path, output_width, output_height) as writer:
+            for index, row in enumerate(image_array):
+                colour_rows = None
+                if colour_array is not None:
+                    colour_rows = self.get_colour_rows(colour_array, index, len(row))
+                writer.write_strip(self.get_collage_band(row, tile_side, loaded_images, colour_rows))
+        print("Loaded", loaded_images.misses, "micro-images for pasting,", loaded_images.hits, "reused")
+
+    def get_colour_rows(self, colour_array, row, columns):
+        """
+        :param colour_array: The main image as an HxWx3 array.
+        :param row: A row of the collage, in micro-images.
+        :param columns: Number of micro-images in the row.
+        :return: The block_size rows of the main image that the row of micro-images replaces.
+        """
+
+        return colour_array[row * self.block_size:(row + 1) * self.block_size, :columns * self.block_size]
+
+    def get_collage_band(self, images, tile_side, loaded_images, colour_rows=None, band=None):
+        """
+        Places a row of micro-images side by side.
+        From a TileAtlas, the whole row is gathered from the atlas in one indexing operation and transposed into place,
+        otherwise micro-images are copied in one at a time.
+
+        :param images: One row of the output of find_closest_image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param loaded_images: A MicroImageCache or TileAtlas.
+        :param colour_rows: The pixels of the main image the row replaces, to blend toward. See blend_band.
+        :param band: A tile_side x (len(images) * tile_side) x 3 uint8 array to fill, or None for a new one.
+        :return: The band.
+        """
+
+        if band is None:
+            band = np.empty((tile_side, len(images) * tile_side, 3), dtype=np.uint8)
+        # Column of micro-images, then row and column within each micro-image
+        tile_columns = band.reshape(tile_side, len(images), tile_side, 3)
+        if isinstance(loaded_images, TileAtlas) and not any(isinstance(image, Image.Image) for image in images):
+            tile_columns[...] = loaded_images.get_tiles(images).transpose(1, 0, 2, 3)
+        else:
+            for column_index, image in enumerate(images):
+                tile_columns[:, column_index] = self.get_pixel_array(loaded_images.get(image))
+        if colour_rows is not None and self.alpha_adjustment:
+            self.blend_band(band, colour_rows)
+        return band
+
+    def blend_band(self, band, colour_rows):
+        """
+        Blends a row of micro-images toward the blocks of the main image they replace, by self.alpha_adjustment.
+        Each segment of a micro-image moves toward the colour of the main image pixel it stands for, so 0 leaves the
+        micro-images unchanged and 1 reproduces the main image.
+        Done for the whole row at once, as one 16-bit multiply for the micro-images' share of each pixel and one
+        broadcast add of the main image's share, so it costs little more than the paste itself.
+
+        :param band: A tile_side x (columns * tile_side) x 3 uint8 array of micro-images, blended in place.
+        :param colour_rows: The block_size x (columns * block_size) x 3 pixels of the main image the band replaces.
+        """
+
+        tile_side = band.shape[0]
+        columns = band.shape[1] // tile_side
+        # Main image pixel that each row and column of a micro-image falls into
+        segment_index = np.arange(tile_side) * self.block_size // tile_side
+        column_index = (np.arange(columns)[:, None] * self.block_size + segment_index).ravel()
+
+        # Rounding down the micro-images' share and rounding the main image's keeps every sum within 0-255
+        tile_share = band.astype(np.uint16)
+        tile_share *= int((1 - self.alpha_adjustment) * 256)
+        tile_share >>= 8
+        band[...] = tile_share
+        colour_share = np.rint(np.asarray(colour_rows, dtype=np.float64) * self.alpha_adjustment).astype(np.uint8)
+        colour_share = colour_share[:, column_index]
+
+        if tile_side % self.block_size == 0:
+            segments = band.reshape(self.block_size, tile_side // self.block_size, band.shape[1], 3)
+            segments += colour_share[:, None]
+        else:
+            band += colour_share[segment_index]
 
     def open_images(self, images):
         """
@@ -80,26 +1005,8 @@ class MosaicCreator:
         """
 
         print("Resizing Images")
-        if self.size_reduction_factor != 1:
-            for index, image in enumerate(images):
-                reduced_width = int(image.width / self.size_reduction_factor)
-                reduced_height = int(image.height / self.size_reduction_factor)
-                images[index] = image.resize(
-                    (reduced_width, reduced_height))
-
         for index, image in enumerate(images):
-            image = self.crop_to_square(image)
-            excess = image.height % self.block_size
-            if not(excess == 0):
-                image = image.resize((image.width - excess, image.height - excess))
-
-            # Resize the image if it is larger than PIL can manage when creating a new image
-            max_pil_image_size = 100000
-            max_image_size = max(max_pil_image_size / self.image_height, max_pil_image_size / self.image_width)
-            max_within_block_size = int(max_image_size - max_image_size % self.block_size)
-            image_size = min(max_within_block_size, image.height)
-            image = image.resize((image_size, image_size))
-            images[index] = image
+            images[index] = self.fit_image(image)
 
         smallest_image = min(images, key=lambda p: p.size)
         for index, image in enumerate(images):  # Used to say opened_images[1:], unsure why
@@ -111,153 +1018,819 @@ class MosaicCreator:
 
         return smallest_image, images
 
-    def find_closest_image(self, colour_array, micro_images):
+    def fit_image(self, image):
         """
-        Iterates through each block of the main image and finds the closest matching micro-image, based on the colours
-        of each pixel.
+        Runs the per-image part of resize_images: applies size_reduction_factor, crops to a square, clips any excess
+        pixels that would not be divisible by the block size and shrinks the image to fit within PIL's limits.
 
-        :param colour_array: The main image, with each pixel represented as an RBG tuple.
-        :param micro_images: Array of all of the micro-images
-        :return: An array representing the finished collage, with image objects in place of the blocks.
+        :param image: A micro-image.
+        :return: The square, resized micro-image.
         """
 
-        print("Finding the closest matching micro-image for each block of the image")
-        image_array = []
-        row_count = 0
+        if self.size_reduction_factor != 1:
+            reduced_width = int(image.width / self.size_reduction_factor)
+            reduced_height = int(image.height / self.size_reduction_factor)
+            image = image.resize((reduced_width, reduced_height))
 
-        block_size = self.block_size
+        image = self.crop_to_square(image)
+        excess = image.height % self.block_size
+        if not(excess == 0):
+            image = image.resize((image.width - excess, image.height - excess))
 
-        while row_count < len(colour_array) - block_size + 1:
-            image_array.append([])
-            column_count = 0
-            while column_count < len(colour_array[0]) - block_size + 1:
-                block_pixels = []
-                for rowPlus in range(block_size):
-                    block_pixels.append([])
-                    for columnPlus in range(block_size):
-                        current_pixel = colour_array[row_count + rowPlus][column_count + columnPlus]
-                        block_pixels[-1].append(current_pixel)
-                closest_image = self.find_matching_micro(block_pixels, micro_images)
-                # print(closest_image)
-                # closest_image = self.apply_alpha_adjustment(block_pixels, closest_image)
-                image_array[-1].append(closest_image)
+        # Resize the image if it is larger than PIL can manage when creating a new image
+        image_size = min(self.get_max_tile_side(), image.height)
+        return image.resize((image_size, image_size))
 
-                column_count += block_size
-            row_count += block_size
-            print("Processed row", row_count)
-        return image_array
+    def get_max_tile_side(self):
+        """
+        Gets the largest micro-image side length, in multiples of the block size, for which the finished collage is
+        still small enough for PIL to create.
+        Streamed TIFF and Deep Zoom output never create the full collage in PIL, so they have no limit.
+        Either way the side length is at most self.tile_side_limit, if set.
 
-    # def apply_alpha_adjustment(self, block_pixels, closest_image):
-    #     # closest_image_blocked = self.get_micro_image_blocks([closest_image])[0][1]
-    #     closest_image_blocked = self.get_pixel_colours(closest_image)
-    #     # print(block_pixels)
-    #     # print(closest_image_blocked)
-    #     flattened_image = []
-    #
-    #     for row_index, row in enumerate(block_pixels):
-    #         for column_index, pixel in enumerate(row):
-    #             for rowPlus in range(self.micro_block_size):
-    #                 for columnPlus in range(self.micro_block_size):
-    #                     image_segment = closest_image_blocked[row_index + rowPlus][column_index + columnPlus]
-    #
-    #                     red_adjustment = round(image_segment[0] - (self.alpha_adjustment * (image_segment[0] - pixel[0])))
-    #                     green_adjustment = round(image_segment[1] - (self.alpha_adjustment * (image_segment[1] - pixel[1])))
-    #                     blue_adjustment = round(image_segment[2] - (self.alpha_adjustment * (image_segment[2] - pixel[2])))
-    #                     # closest_image_blocked[row_index][pixel_index] = (red_adjustment, green_adjustment, blue_adjustment)
-    #                     flattened_image.append((red_adjustment, green_adjustment, blue_adjustment))
-    #     # print(closest_image_blocked)
-    #     image_size = (len(closest_image_blocked), len(closest_image_blocked))
-    #     closest_image_with_alpha = Image.new("RGB", image_size)
-    #     closest_image_with_alpha.putdata(flattened_image)
-    #     # print(closest_image_with_alpha)
-    #     return closest_image_with_alpha
+        :return: The maximum side length in pixels.
+        """
 
+        limit = self.tile_side_limit or math.inf
+        if self.output_format in ('tiff', 'dzi'):
+            return limit
 
+        max_pil_image_size = 100000
+        max_image_size = max(max_pil_image_size / self.image_height, max_pil_image_size / self.image_width)
+        return min(limit, int(max_image_size - max_image_size % self.block_size))
 
-    def get_micro_image_blocks(self, micro_images):
+    def plan_job(self, micro_images, main_images, memory_budget=None):
         """
-        Divides all micro-images into segments based on self.block_size to compare each segment against main image.
-        Segment size is determines by the height and width of the micro-image being divided by the block size.
-        For example, a block size of 5 will result in 25 segments for each image, which correspond to the 25 pixels in
-        each block of the larger image.
+        Estimates the memory and output size a job will need before any heavy work is done, from the image headers
+        alone. Given a memory budget, also works out settings that fit within it: fewer ingest and matching workers
+        first, then smaller pipeline bands, and only then smaller micro-images. Apply them with apply_plan.
 
-        :param micro_images: Array of all images to be segmented
-        :return: The average colour of each segment, for each image in the micro_images array
+        :param micro_images: Array of paths to the micro-images.
+        :param main_images: Array of paths to the main images. The largest decides the plan.
+        :param memory_budget: Bytes the whole job, worker processes included, must fit in. None only estimates the
+                              current settings.
+        :return: A dictionary of the chosen tile_side, ingest_workers, match_workers and pipeline_band_rows, and the
+                 estimate for them (see estimate_memory).
         """
 
-        # print("Dividing micro-images into segments to compare against larger image pixels")
-        micro_block_colours = []
-        count = 1
-
-        for image in micro_images:
-            self.micro_block_size = image.height // self.block_size
-            colour_array = self.get_pixel_colours(image)
-            colour_array = self.get_average_pixels(colour_array, self.micro_block_size)
+        main_size = max((Image.open(main_image).size for main_image in main_images), key=lambda size: size[0] * size[1])
+        micro_sizes = [Image.open(image).size for image in micro_images]
+        self.image_width, self.image_height = main_size
+        tile_side = min(self.get_max_tile_side(), min(self.get_fitted_side(*size) for size in micro_sizes))
+        largest_micro_image = max(width * height for width, height in micro_sizes)
 
-            micro_block_colours.append((image, colour_array))
+        def make_plan(tile_side, ingest_workers, match_workers, band_rows):
+            estimate = self.estimate_memory(main_size, len(micro_images), tile_side, largest_micro_image,
+                                            ingest_workers, match_workers, band_rows)
+            return dict(estimate, tile_side=tile_side, ingest_workers=ingest_workers, match_workers=match_workers,
+                        pipeline_band_rows=band_rows)
 
-            count += 1
+        plan = make_plan(tile_side, self.ingest_workers, self.match_workers, self.pipeline_band_rows)
+        if memory_budget is None or plan['peak_bytes'] <= memory_budget:
+            return plan
 
-        return micro_block_colours
+        candidates = []
+        for side in range(tile_side, self.block_size - 1, -self.block_size):
+            for band_rows in sorted({self.pipeline_band_rows, 1}, reverse=True):
+                for workers in range(max(self.ingest_workers, self.match_workers), 0, -1):
+                    candidates.append((side, min(workers, self.ingest_workers), min(workers, self.match_workers),
+                                       band_rows))
+        for settings in candidates:
+            plan = make_plan(*settings)
+            if plan['peak_bytes'] <= memory_budget:
+                print("Planned micro-images of", plan['tile_side'], "pixels,", plan['ingest_workers'], "ingest and",
+                      plan['match_workers'], "matching workers to fit", int(memory_budget // 2 ** 20), "MB")
+                return plan
+        raise ValueError("The job needs at least %d MB even with %d pixel micro-images and one worker, the budget is "
+                         "%d MB" % (plan['peak_bytes'] // 2 ** 20, self.block_size, memory_budget // 2 ** 20))
 
-    def find_matching_micro(self, block_pixels, micro_images):
+    def apply_plan(self, plan):
         """
-        Finds the micro-image which best matches the pixels of the block in the main image to the segments of the
-        micro-image.
-        This is done by comparing the total RBG difference for each pixel, and finding the micro-image which has the
-        least difference to the original image.
+        Uses the settings chosen by plan_job for the next collages.
 
-        :param block_pixels: An array of the colour values of all of the pixel in a block of the main image.
-        :param micro_images: Array of all of the micro-images
-        :return: The closest matching image to the block
+        :param plan: Output of plan_job.
         """
-        differences = []
-        for micro_image in micro_images:
-            image_colours = micro_image[1]
-            colour_difference = 0
-            for row_index, row in enumerate(block_pixels):
-                for column_index, pixel in enumerate(row):
-                    difference = self.get_pixel_difference(pixel, image_colours[row_index][column_index])
-                    colour_difference += difference
-            differences.append((micro_image[0], colour_difference))
-        closest_image = min(differences, key=lambda x: x[1])
-        return closest_image[0]
 
-    def get_pixel_difference(self, pixel, micro_image_pixel):
+        self.tile_side_limit = plan['tile_side']
+        self.ingest_workers = plan['ingest_workers']
+        self.match_workers = plan['match_workers']
+        self.pipeline_band_rows = plan['pipeline_band_rows']
+
+    def estimate_memory(self, main_size, tile_count, tile_side, largest_micro_image, ingest_workers, match_workers,
+                        band_rows):
         """
-        Gets the total RBG difference between the pixel from the main image and the segment from the micro-image.
+        Estimates the peak memory of making one collage, and the size of the file it will produce. The estimate for
+        this process can be compared with the peak_rss MosaicMetrics measures for the collage.
 
-        :param pixel: The RBG colour values of a pixel in the main image.
-        :param micro_image_pixel: The average RBG colour values in the corresponding segment of a micro-image.
-        :return: The total RBG difference between the two colour values.
+        :param main_size: (width, height) of the main image.
+        :param tile_count: Number of micro-images.
+        :param tile_side: Side length of every micro-image in the collage.
+        :param largest_micro_image: Pixel count of the largest micro-image, as decoded.
+        :param ingest_workers: Processes decoding micro-images.
+        :param match_workers: Threads matching blocks.
+        :param band_rows: Rows of blocks matched at a time in a pipeline.
+        :return: A dictionary of peak_bytes for the whole job, process_bytes for this process alone, worker_bytes for
+                 the ingest processes, output_bytes, and the breakdown of process_bytes by stage.
         """
 
-        difference = 0
-        for i in range(2):
-            difference += abs(pixel[i] - micro_image_pixel[i])
-        return difference
+        width, height = main_size
+        rows, columns = height // self.block_size, width // self.block_size
+        output_width, output_height = columns * tile_side, rows * tile_side
+        if self.output_format == 'jpg':
+            output_width = max(output_width, width * (tile_side // self.block_size))
+            output_height = max(output_height, height * (tile_side // self.block_size))
+        channels = 2 if self.metric == 'absolute' else 3
+        feature_length = self.block_size * self.block_size * channels
+        band_bytes = tile_side * output_width * 3
 
-    def crop_to_square(self, image):
-        """
-        Crops an image to be completely square, based on the smallest side of the image.
+        breakdown = {
+            'baseline': get_current_rss(),
+            # The decoded main image, its array and its blocks
+            'main_image': width * height * 3 * 3,
+            # Raw and prepared micro-image features, and prepared features for the blocks being matched
+            'features': tile_count * feature_length * 8 * 2 +
+                        (min(rows, band_rows) * columns if self.pipeline else rows * columns) * feature_length * 8,
+            # The distance matrix and its temporaries for each matching thread
+            'matching': MATCH_CHUNK_BYTES * match_workers,
+            # Micro-images are decoded here only without worker processes
+            'decoding': largest_micro_image * 4 * 2 if ingest_workers <= 1 else 0,
+        }
+        if self.max_tile_uses or self.min_repeat_distance > 1:
+            candidates = min(self.constraint_candidates or tile_count, tile_count)
+            breakdown['matching'] += rows * columns * candidates * 16 * 2
 
-        :param image: Image to be cropped.
-        :return: The cropped image.
-        """
+        # Resized micro-images held for pasting, as PIL images of 4 bytes a pixel, or the atlas pages mapped in
+        if self.tile_atlas_path:
+            breakdown['micro_images'] = tile_count * tile_side * tile_side * 3
+        else:
+            breakdown['micro_images'] = min(self.micro_image_cache_bytes, tile_count * tile_side * tile_side * 4)
 
-        small_side = min(image.size)
-        center = (image.size[0] / 2, image.size[1] / 2)
-        half_side = small_side / 2
-        crop_box = (center[0] - half_side, center[1] - half_side, center[0] + half_side, center[1] + half_side)
-        return image.crop(crop_box)
+        if self.output_format == 'jpg':
+            # The canvas, and PIL's copy of it at 4 bytes a pixel while encoding
+            breakdown['collage'] = output_width * output_height * (3 + 4)
+            output_bytes = output_width * output_height * JPEG_BYTES_PER_PIXEL
+        else:
+            # Rows in flight between stages, plus the blending temporaries for one row
+            bands = self.pipeline_depth + 2 if self.pipeline else 1
+            breakdown['collage'] = band_bytes * bands + (band_bytes * 2 if self.alpha_adjustment else 0)
+            output_bytes = output_width * output_height * 3
+            if self.output_format == 'dzi':
+                # The full resolution level buffers a row of 256 pixel tiles plus a row of micro-images, twice while
+                # joining them, and the levels below it and the halving take about as much again as one tile row
+                breakdown['collage'] += ((256 + tile_side) * 2 + 256 * 2) * output_width * 3
+                output_bytes = output_width * output_height * JPEG_BYTES_PER_PIXEL * 4 / 3
 
-    def get_pixel_colours(self, image):
+        process_bytes = sum(breakdown.values())
+        worker_bytes = 0
+        if ingest_workers > 1:
+            worker_bytes = ingest_workers * (WORKER_PROCESS_BYTES + largest_micro_image * 4 * 2)
+        return {'peak_bytes': process_bytes + worker_bytes, 'process_bytes': process_bytes,
+                'worker_bytes': worker_bytes, 'output_bytes': int(output_bytes), 'breakdown': breakdown}
+
+    def get_fitted_side(self, width, height):
         """
-        Gets the colour matrix for each pixel of an image, and returns an array of colour matrices.
-        Each sub-array corresponds to a row of pixels in the original image.
+        Works out the side length fit_image would produce for an image of the given size, without decoding it.
+        Does not include the PIL limit applied by get_max_tile_side.
 
-        :param image: Image for which to retrieve the colour values.
-        :return: An array of arrays of RGB colour matrices, where each matrix = one pixel.
+        :param width: Width of the original micro-image.
+        :param height: Height of the original micro-image.
+        :return: The side length in pixels.
+        """
+
+        if self.size_reduction_factor != 1:
+            width = int(width / self.size_reduction_factor)
+            height = int(height / self.size_reduction_factor)
+        side = min(width, height)
+        return side - side % self.block_size
+
+    def prepare_micro_image(self, image, tile_side):
+        """
+        Produces a square micro-image of the final side length, from the centre of the original.
+        JPEGs are decoded at the smallest scale that is still at least tile_side, then cropped and resized in a single
+        step. With self.legacy_resize this instead produces the same micro-image as resize_images.
+
+        :param image: A micro-image, or the path to one.
+        :param tile_side: Side length of every micro-image in the collage.
+        :return: The resized micro-image.
+        """
+
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        if self.legacy_resize:
+            image = self.fit_image(image)
+            if image.size != (tile_side, tile_side):
+                image = image.resize((tile_side, tile_side))
+            return image
+
+        scale = tile_side / min(image.size)
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        side = min(image.size)
+        left = (image.width - side) / 2
+        top = (image.height - side) / 2
+        return image.resize((tile_side, tile_side), box=(left, top, left + side, top + side), reducing_gap=2.0)
+
+    def get_micro_image_features(self, image_path, tile_side):
+        """
+        Loads one micro-image and gets the average colour of each of its segments.
+
+        :param image_path: Path to the micro-image.
+        :param tile_side: Side length of every micro-image in the collage.
+        :return: A block_size x block_size x 3 array of segment averages.
+        """
+
+        image = self.prepare_micro_image(image_path, tile_side)
+        return self.get_block_averages(self.get_pixel_array(image), tile_side // self.block_size)
+
+    def load_micro_image_blocks(self, micro_images, max_tile_side=None):
+        """
+        Gets the segment averages of every micro-image (as get_micro_image_blocks does) without keeping the
+        micro-images in memory. Each one is decoded, resized and measured in turn, then dropped, spread over
+        self.ingest_workers processes.
+        If self.tile_cache_path is set, any micro-image which has not changed since the last run is not decoded at all.
+
+        :param micro_images: Array of paths to the micro-images.
+        :param max_tile_side: Largest allowed micro-image side length. Defaults to get_max_tile_side.
+        :return: The micro-image side length, and an array of (path, segment averages) tuples.
+        """
+
+        if max_tile_side is None:
+            max_tile_side = self.get_max_tile_side()
+        cache = self.read_tile_cache()
+        entries = []
+        for image_path in micro_images:
+            image_path = path.abspath(image_path)
+            image_stat = stat(image_path)
+            entry = cache.get(image_path)
+            if entry is None or entry['mtime'] != image_stat.st_mtime or entry['size'] != image_stat.st_size:
+                # Opening only reads the header, the image is decoded later if its features are needed
+                width, height = Image.open(image_path).size
+                entry = {'mtime': image_stat.st_mtime, 'size': image_stat.st_size,
+                         'fitted_side': self.get_fitted_side(width, height), 'tile_side': 0, 'features': None}
+            entries.append((image_path, entry))
+
+        tile_side = min(max_tile_side, min(entry['fitted_side'] for _, entry in entries))
+
+        stale = [(image_path, entry) for image_path, entry in entries if entry['tile_side'] != tile_side]
+        print("Micro-image cache:", len(entries) - len(stale), "reused,", len(stale), "to decode")
+        stale_paths = [image_path for image_path, _ in stale]
+        if self.ingest_workers > 1 and len(stale) > self.ingest_workers:
+            # Micro-images are decoded in separate processes, only the segment averages are sent back
+            chunk_size = max(1, len(stale) // (self.ingest_workers * 4))
+            with ProcessPoolExecutor(max_workers=self.ingest_workers) as executor:
+                features = list(executor.map(self.get_micro_image_features, stale_paths, [tile_side] * len(stale),
+                                             chunksize=chunk_size))
+        elif self.pipeline:
+            # Micro-images are decoded in one thread while the previous ones are measured in this one
+            segment_size = tile_side // self.block_size
+            decoded = self.run_ahead((self.prepare_micro_image(image_path, tile_side) for image_path in stale_paths),
+                                     'decoding')
+            features = [self.get_block_averages(self.get_pixel_array(image), segment_size) for image in decoded]
+        else:
+            features = [self.get_micro_image_features(image_path, tile_side) for image_path in stale_paths]
+        self.metrics.count('micro_images_decoded', len(stale))
+        self.metrics.count('micro_images_cached', len(entries) - len(stale))
+        for (image_path, entry), image_features in zip(stale, features):
+            entry['features'] = image_features
+            entry['tile_side'] = tile_side
+
+        if stale or len(cache) != len(entries):
+            self.write_tile_cache(entries)
+        return tile_side, [(image_path, entry['features']) for image_path, entry in entries]
+
+    def read_tile_cache(self):
+        """
+        Reads the micro-image cache written by write_tile_cache.
+        The cache is ignored if it was built with a different block size, size reduction factor or resize method.
+
+        :return: A dictionary of absolute path to cache entry.
+        """
+
+        if not self.tile_cache_path or not path.exists(self.tile_cache_path):
+            return {}
+        with np.load(self.tile_cache_path) as cache:
+            if int(cache['block_size']) != self.block_size or \
+                    float(cache['size_reduction_factor']) != self.size_reduction_factor or \
+                    'legacy_resize' not in cache or bool(cache['legacy_resize']) != self.legacy_resize:
+                return {}
+            entries = {}
+            for index, image_path in enumerate(cache['paths']):
+                entries[str(image_path)] = {'mtime': float(cache['mtimes'][index]),
+                                            'size': int(cache['sizes'][index]),
+                                            'fitted_side': int(cache['fitted_sides'][index]),
+                                            'tile_side': int(cache['tile_sides'][index]),
+                                            'features': cache['features'][index]}
+        return entries
+
+    def write_tile_cache(self, entries):
+        """
+        Saves the micro-image segment averages to self.tile_cache_path, so later runs can skip decoding them.
+
+        :param entries: Array of (absolute path, cache entry) tuples.
+        """
+
+        if not self.tile_cache_path:
+            return
+        temp_path = self.tile_cache_path + ".tmp.npz"
+        np.savez(temp_path,
+                 block_size=self.block_size,
+                 size_reduction_factor=self.size_reduction_factor,
+                 legacy_resize=self.legacy_resize,
+                 paths=np.array([image_path for image_path, _ in entries]),
+                 mtimes=np.array([entry['mtime'] for _, entry in entries], dtype=np.float64),
+                 sizes=np.array([entry['size'] for _, entry in entries], dtype=np.int64),
+                 fitted_sides=np.array([entry['fitted_side'] for _, entry in entries], dtype=np.int64),
+                 tile_sides=np.array([entry['tile_side'] for _, entry in entries], dtype=np.int64),
+                 features=np.stack([entry['features'] for _, entry in entries]))
+        replace(temp_path, self.tile_cache_path)
+
+    def find_closest_image(self, colour_array, micro_images):
+        """
+        Iterates through each block of the main image and finds the closest matching micro-image, based on the colours
+        of each pixel.
+        All blocks are matched against all micro-images at once, in chunks, using match_features.
+
+        :param colour_array: The main image as an HxWx3 array of RGB values (see get_pixel_array).
+        :param micro_images: Array of all of the micro-images
+        :return: An array representing the finished collage, with image objects in place of the blocks.
+        """
+
+        return self.find_closest_tiles(colour_array, micro_images).get_image_array()
+
+    def find_closest_tiles(self, colour_array, micro_images, tile_side=None):
+        """
+        Finds the closest matching micro-image for each block of the main image, as a grid of micro-image numbers.
+
+        :param colour_array: The main image as an HxWx3 array of RGB values (see get_pixel_array).
+        :param micro_images: Output of get_micro_image_blocks or load_micro_image_blocks.
+        :param tile_side: Side length of the micro-images the collage will be rendered with, if known.
+        :return: An AssignmentGrid.
+        """
+
+        print("Finding the closest matching micro-image for each block of the image")
+        block_features, grid_shape = self.get_block_features(colour_array)
+        self.metrics.count('blocks_matched', len(block_features))
+        tile_features, tile_index = self.prepare_tiles(micro_images)
+        if self.max_tile_uses or self.min_repeat_distance > 1:
+            matches = ConstrainedAssigner(self, tile_features).assign(self.prepare_features(block_features),
+                                                                      grid_shape)
+        else:
+            matches = self.match_features(self.prepare_features(block_features), tile_features, tile_index)
+        if self.match_cache is not None:
+            print("Match cache:", self.match_cache.hits, "hits,", self.match_cache.misses, "misses")
+        return AssignmentGrid(matches.reshape(grid_shape), [image for image, _ in micro_images], self.block_size,
+                              (colour_array.shape[1], colour_array.shape[0]), tile_side,
+                              self.get_assignment_colours(colour_array, grid_shape))
+
+    def get_assignment_colours(self, colour_array, grid_shape):
+        """
+        :param colour_array: The main image as an HxWx3 array of RGB values.
+        :param grid_shape: Rows and columns of blocks.
+        :return: The pixels of the main image covered by blocks, for an AssignmentGrid to blend toward when rendered
+                 again, or None if collages are not blended.
+        """
+
+        if not self.alpha_adjustment:
+            return None
+        rows, columns = grid_shape
+        return np.ascontiguousarray(colour_array[:rows * self.block_size, :columns * self.block_size], dtype=np.uint8)
+
+    def check_assignment_colours(self, assignment):
+        """
+        Makes sure an AssignmentGrid can be rendered the way self.alpha_adjustment asks.
+
+        :param assignment: The AssignmentGrid.
+        """
+
+        if not self.alpha_adjustment:
+            return
+        if assignment.colours is None:
+            raise ValueError("The assignment was saved without the main image's colours, so it can only be rendered "
+                             "with alpha_adjustment 0 (--alpha-adjustment 0)")
+        if assignment.block_size != self.block_size:
+            raise ValueError("The assignment was matched with a block size of %d, not %d"
+                             % (assignment.block_size, self.block_size))
+
+    def get_image_array(self, matches, micro_images):
+        """
+        Swaps a grid of micro-image indices for the micro-images themselves.
+
+        :param matches: A rows x columns array of indices into micro_images.
+        :param micro_images: Output of get_micro_image_blocks or load_micro_image_blocks.
+        :return: An array representing the finished collage, with image objects (or paths) in place of the blocks.
+        """
+
+        image_array = []
+        for row in matches:
+            image_array.append([micro_images[index][0] for index in row])
+        return image_array
+
+    def get_block_features(self, colour_array):
+        """
+        Splits the main image into blocks and flattens each block into a feature vector of pixel colours.
+
+        :param colour_array: The main image as an HxWx3 array of RGB values.
+        :return: A (number of blocks, block_size * block_size, 3) array, and the (rows, columns) shape of the block
+                 grid.
+        """
+
+        blocks = self.get_image_blocks(colour_array, self.block_size)
+        rows, columns = blocks.shape[:2]
+        return blocks.reshape(rows * columns, self.block_size * self.block_size, 3), (rows, columns)
+
+    def get_tile_features(self, micro_images):
+        """
+        Stacks the segment averages produced by get_micro_image_blocks into a single array.
+
+        :param micro_images: Output of get_micro_image_blocks.
+        :return: A (number of micro-images, block_size * block_size, 3) float array.
+        """
+
+        if not micro_images:
+            raise ValueError("At least one micro-image is required")
+        features = np.stack([np.asarray(colours, dtype=np.float64) for _, colours in micro_images])
+        return features.reshape(len(micro_images), -1, 3)
+
+    def prepare_features(self, features):
+        """
+        Converts (N, block_size * block_size, 3) features into the flat float layout compared by self.metric.
+
+        :param features: Block or micro-image features.
+        :return: A (N, feature length) float64 array.
+        """
+
+        features = np.asarray(features, dtype=np.float64)
+        if self.metric == 'absolute':
+            features = features[..., :2]
+        elif self.metric == 'lab':
+            features = self.get_lab_colours(features)
+        return np.ascontiguousarray(features.reshape(features.shape[0], -1))
+
+    def get_lab_colours(self, colours):
+        """
+        Converts sRGB colours to CIELAB (D65). Gamma is removed through the SRGB_TO_LINEAR lookup table rather than
+        per colour powers, so converting every block and micro-image segment costs little next to matching them.
+        a and b are offset by 128 so, like RGB, every channel is roughly within 0-256. This does not change any
+        difference between colours.
+
+        :param colours: An array of RGB colours, (..., 3).
+        :return: The Lab colours, the same shape.
+        """
+
+        linear = np.interp(colours, np.arange(256), SRGB_TO_LINEAR)
+        xyz = linear @ LINEAR_TO_XYZ.T
+        scaled = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+        lab = np.empty_like(scaled)
+        lab[..., 0] = 116 * scaled[..., 1] - 16
+        lab[..., 1] = 500 * (scaled[..., 0] - scaled[..., 1]) + 128
+        lab[..., 2] = 200 * (scaled[..., 1] - scaled[..., 2]) + 128
+        return lab
+
+    def get_distance_matrix(self, block_features, tile_features, counter='distance_evaluations'):
+        """
+        Computes the colour difference between every block and every micro-image in one go.
+        Both arguments must already have been through prepare_features.
+
+        :param block_features: A (number of blocks, feature length) array.
+        :param tile_features: A (number of micro-images, feature length) array.
+        :param counter: Counter in self.metrics to add the number of comparisons to.
+        :return: A (number of blocks, number of micro-images) array of differences.
+        """
+
+        self.metrics.count(counter, block_features.shape[0] * tile_features.shape[0])
+        if self.metric in SQUARED_METRICS:
+            block_norms = np.einsum('ij,ij->i', block_features, block_features)
+            tile_norms = np.einsum('ij,ij->i', tile_features, tile_features)
+            distances = block_features @ tile_features.T
+            distances *= -2
+            distances += block_norms[:, None]
+            distances += tile_norms[None, :]
+            return np.maximum(distances, 0, out=distances)
+
+        # Accumulate one feature column at a time so memory stays at blocks x micro-images
+        distances = np.zeros((block_features.shape[0], tile_features.shape[0]))
+        difference = np.empty_like(distances)
+        tile_columns = np.ascontiguousarray(tile_features.T)
+        for column in range(block_features.shape[1]):
+            np.subtract(block_features[:, column, None], tile_columns[column], out=difference)
+            np.abs(difference, out=difference)
+            distances += difference
+        return distances
+
+    def get_match_chunk_size(self, tile_count):
+        """
+        Number of blocks to compare per chunk, so that each distance matrix stays around MATCH_CHUNK_BYTES.
+        This deliberately does not depend on self.match_workers, so results are identical however many threads run.
+
+        :param tile_count: Number of micro-images being compared against.
+        :return: Blocks per chunk.
+        """
+
+        if self.match_chunk_size:
+            return self.match_chunk_size
+        # Allow for the float64 distance matrix plus two temporaries of the same size
+        return max(1, MATCH_CHUNK_BYTES // (min(tile_count, MATCH_TILE_CHUNK) * 8 * 3))
+
+    def run_parallel(self, function, items):
+        """
+        Calls function on every item using self.match_workers threads. NumPy releases the GIL while it works, so the
+        distance calculations run on multiple cores.
+
+        :param function: Function taking one item.
+        :param items: Items to process.
+        """
+
+        items = list(items)
+        if self.match_workers <= 1 or len(items) <= 1:
+            for item in items:
+                function(item)
+            return
+        with ThreadPoolExecutor(max_workers=self.match_workers) as executor:
+            # Consume the results so that any exception is raised here
+            for _ in executor.map(function, items):
+                pass
+
+    def prepare_tiles(self, micro_images):
+        """
+        Gets the prepared micro-image features, and TileIndex if self.match_index is set, for matching against.
+        These are kept until a different list of micro-images is used, so a batch of collages only builds them once.
+
+        :param micro_images: Output of get_micro_image_blocks or load_micro_image_blocks.
+        :return: The prepared features, and the TileIndex or None.
+        """
+
+        if self.prepared_tiles is None or self.prepared_tiles[0] is not micro_images:
+            tile_features = self.prepare_features(self.get_tile_features(micro_images))
+            tile_index = TileIndex(self, tile_features) if self.match_index == 'grid' else None
+            self.prepared_tiles = (micro_images, tile_features, tile_index)
+        return self.prepared_tiles[1], self.prepared_tiles[2]
+
+    def match_features(self, block_features, tile_features, tile_index=None):
+        """
+        Finds the closest micro-image for every block, using whichever search the MosaicCreator is set up for.
+
+        :param block_features: Prepared block features.
+        :param tile_features: Prepared micro-image features.
+        :param tile_index: A TileIndex over tile_features to reuse, if self.match_index is set.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        if self.match_cache_step is not None:
+            self.match_cache = self.match_cache or MatchCache(self)
+            return self.match_cache.match(block_features, tile_features,
+                                          lambda blocks: self.search_features(blocks, tile_features, tile_index))
+        return self.search_features(block_features, tile_features, tile_index)
+
+    def search_features(self, block_features, tile_features, tile_index=None):
+        """
+        Searches for the closest micro-image to every block, without the match cache.
+
+        :param block_features: Prepared block features.
+        :param tile_features: Prepared micro-image features.
+        :param tile_index: A TileIndex over tile_features to reuse, if self.match_index is set.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        if self.match_index == 'grid':
+            tile_index = tile_index or TileIndex(self, tile_features)
+            return tile_index.query(block_features, self.match_epsilon)
+        if self.match_candidates and self.match_candidates < len(tile_features):
+            return self.find_best_candidates(block_features, tile_features)
+        return self.compare_all(block_features, tile_features)
+
+    def compare_all(self, block_features, tile_features):
+        """
+        Finds the closest micro-image for every block by comparing it against every micro-image.
+
+        :param block_features: Prepared block features.
+        :param tile_features: Prepared micro-image features.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        chunk_size = self.get_match_chunk_size(len(tile_features))
+        matches = np.empty(len(block_features), dtype=np.intp)
+
+        def match_chunk(start):
+            blocks = block_features[start:start + chunk_size]
+            best_distances = np.full(len(blocks), np.inf)
+            best_indices = np.zeros(len(blocks), dtype=np.intp)
+            for tile_start in range(0, len(tile_features), MATCH_TILE_CHUNK):
+                distances = self.get_distance_matrix(blocks, tile_features[tile_start:tile_start + MATCH_TILE_CHUNK])
+                closest = distances.argmin(axis=1)
+                closest_distances = distances[np.arange(len(blocks)), closest]
+                # Strictly less than, so ties go to the earlier micro-image as with a single argmin
+                better = closest_distances < best_distances
+                best_distances[better] = closest_distances[better]
+                best_indices[better] = closest[better] + tile_start
+            matches[start:start + chunk_size] = best_indices
+
+        self.run_parallel(match_chunk, range(0, len(block_features), chunk_size))
+        return matches
+
+    def get_summary_features(self, features):
+        """
+        Shrinks prepared features to the average colour of each quarter of the block (or of the whole block, if the
+        block size is odd).
+        Multiplied by the pixels in each quarter, the difference between two summaries can never be more than the
+        difference between the full features, so it is a lower bound on the full difference.
+
+        :param features: Prepared features, (N, feature length).
+        :return: The summary features, (N, summary length), and the pixel count each summary value stands for.
+        """
+
+        grid = 2 if self.block_size % 2 == 0 else 1
+        cell = self.block_size // grid
+        channels = features.shape[1] // (self.block_size * self.block_size)
+        summary = features.reshape(len(features), grid, cell, grid, cell, channels).mean(axis=(2, 4))
+        return np.ascontiguousarray(summary.reshape(len(features), -1)), cell * cell
+
+    def get_paired_distances(self, block_features, candidate_features):
+        """
+        Computes the difference between each block and each of its own candidate micro-images.
+
+        :param block_features: Prepared block features, (number of blocks, feature length).
+        :param candidate_features: Prepared micro-image features, (number of blocks, candidates, feature length).
+        :return: A (number of blocks, candidates) array of differences.
+        """
+
+        self.metrics.count('distance_evaluations', candidate_features.shape[0] * candidate_features.shape[1])
+        difference = candidate_features - block_features[:, None, :]
+        if self.metric in SQUARED_METRICS:
+            return np.einsum('ijk,ijk->ij', difference, difference)
+        return np.abs(difference, out=difference).sum(axis=2)
+
+    def find_best_candidates(self, block_features, tile_features):
+        """
+        Coarse to fine matching. Every micro-image is ranked by the lower bound from get_summary_features, then only
+        the self.match_candidates lowest are compared in full.
+        With self.match_exact, blocks whose best candidate is not below the lower bound of every other micro-image are
+        compared against all of the micro-images, so the result is the same as a full search.
+
+        :param block_features: Prepared block features.
+        :param tile_features: Prepared micro-image features.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        candidate_count = self.match_candidates
+        block_summaries, summary_weight = self.get_summary_features(block_features)
+        tile_summaries, _ = self.get_summary_features(tile_features)
+        # The lower bounds are cheap, so allow a larger chunk than a full comparison
+        chunk_size = self.match_chunk_size or max(1, 8 * MATCH_CHUNK_BYTES // (len(tile_features) * 8 * 3))
+        matches = np.empty(len(block_features), dtype=np.intp)
+        unproven = []
+
+        def match_chunk(start):
+            blocks = block_features[start:start + chunk_size]
+            # Counted apart from full comparisons, which are what pruning is meant to save
+            lower_bounds = self.get_distance_matrix(block_summaries[start:start + chunk_size], tile_summaries,
+                                                    'lower_bound_evaluations')
+            lower_bounds *= summary_weight
+            ranked = np.argpartition(lower_bounds, candidate_count, axis=1)
+            # Sorted so that ties go to the lowest micro-image index, as in a full search
+            candidates = np.sort(ranked[:, :candidate_count], axis=1)
+            distances = self.get_paired_distances(blocks, tile_features[candidates])
+            closest = distances.argmin(axis=1)
+            rows = np.arange(len(blocks))
+            matches[start:start + chunk_size] = candidates[rows, closest]
+
+            if self.match_exact:
+                next_bound = lower_bounds[rows, ranked[:, candidate_count]]
+                unproven.extend(start + np.flatnonzero(distances[rows, closest] >= next_bound))
+
+        self.run_parallel(match_chunk, range(0, len(block_features), chunk_size))
+
+        if unproven:
+            unproven = np.sort(np.array(unproven, dtype=np.intp))
+            self.metrics.count('candidate_fallbacks', len(unproven))
+            matches[unproven] = self.compare_all(block_features[unproven], tile_features)
+        return matches
+
+    def get_micro_image_blocks(self, micro_images):
+        """
+        Divides all micro-images into segments based on self.block_size to compare each segment against main image.
+        Segment size is determines by the height and width of the micro-image being divided by the block size.
+        For example, a block size of 5 will result in 25 segments for each image, which correspond to the 25 pixels in
+        each block of the larger image.
+
+        :param micro_images: Array of all images to be segmented
+        :return: The average colour of each segment (a block_size x block_size x 3 array), for each image in the
+                 micro_images array
+        """
+
+        # print("Dividing micro-images into segments to compare against larger image pixels")
+        micro_block_colours = []
+        count = 1
+
+        for image in micro_images:
+            self.micro_block_size = image.height // self.block_size
+            colour_array = self.get_pixel_array(image)
+            colour_array = self.get_block_averages(colour_array, self.micro_block_size)
+
+            micro_block_colours.append((image, colour_array))
+
+            count += 1
+
+        return micro_block_colours
+
+    def find_matching_micro(self, block_pixels, micro_images):
+        """
+        Finds the micro-image which best matches the pixels of the block in the main image to the segments of the
+        micro-image.
+        This is done by comparing the total RBG difference for each pixel, and finding the micro-image which has the
+        least difference to the original image.
+
+        :param block_pixels: A block_size x block_size x 3 array of the colour values of a block of the main image.
+        :param micro_images: Array of all of the micro-images
+        :return: The closest matching image to the block
+        """
+        block_features = self.prepare_features(np.reshape(block_pixels, (1, -1, 3)))
+        tile_features = self.prepare_features(self.get_tile_features(micro_images))
+        differences = self.get_distance_matrix(block_features, tile_features)[0]
+        return micro_images[int(differences.argmin())][0]
+
+    def get_pixel_difference(self, pixel, micro_image_pixel):
+        """
+        Gets the total RBG difference between the pixel from the main image and the segment from the micro-image.
+        Also accepts arrays of pixels (last axis = colour channel), in which case one difference per pixel is returned.
+
+        :param pixel: The RBG colour values of a pixel in the main image.
+        :param micro_image_pixel: The average RBG colour values in the corresponding segment of a micro-image.
+        :return: The total RBG difference between the two colour values.
+        """
+
+        pixel = np.asarray(pixel, dtype=np.float64)
+        micro_image_pixel = np.asarray(micro_image_pixel, dtype=np.float64)
+        return np.abs(pixel[..., :2] - micro_image_pixel[..., :2]).sum(axis=-1)
+
+    def crop_to_square(self, image):
+        """
+        Crops an image to be completely square, based on the smallest side of the image.
+
+        :param image: Image to be cropped.
+        :return: The cropped image.
+        """
+
+        small_side = min(image.size)
+        center = (image.size[0] / 2, image.size[1] / 2)
+        half_side = small_side / 2
+        crop_box = (center[0] - half_side, center[1] - half_side, center[0] + half_side, center[1] + half_side)
+        return image.crop(crop_box)
+
+    def get_pixel_array(self, image):
+        """
+        Gets the colour values of every pixel of an image as a single NumPy array.
+        Replaces get_pixel_colours for anything performance sensitive, as the pixel data is copied out of PIL once
+        rather than one getpixel call per pixel.
+
+        :param image: Image for which to retrieve the colour values. Arrays, such as micro-images from a TileAtlas, are
+                      returned as they are.
+        :return: A height x width x 3 uint8 array of RGB values.
+        """
+
+        if isinstance(image, np.ndarray):
+            return image
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return np.asarray(image)
+
+    def get_image_blocks(self, pixel_array, block_size):
+        """
+        Splits a pixel array into square blocks without copying. Any pixels on the right or bottom edge which do not
+        fill a whole block are dropped, in the same way as get_average_pixels.
+
+        :param pixel_array: A height x width x 3 array of RGB values.
+        :param block_size: Width and height of each block, in pixels.
+        :return: A rows x columns x block_size x block_size x 3 view of the pixel array.
+        """
+
+        rows = pixel_array.shape[0] // block_size
+        columns = pixel_array.shape[1] // block_size
+        trimmed = pixel_array[:rows * block_size, :columns * block_size]
+        blocks = trimmed.reshape(rows, block_size, columns, block_size, pixel_array.shape[2])
+        return blocks.transpose(0, 2, 1, 3, 4)
+
+    def get_block_averages(self, pixel_array, block_size):
+        """
+        Gets the average colour of each square of pixels for the entire image.
+        Array equivalent of get_average_pixels with a custom block size.
+
+        :param pixel_array: A height x width x 3 array of RGB values.
+        :param block_size: Width and height of each square, in pixels.
+        :return: A rows x columns x 3 float array of average colours.
+        """
+
+        blocks = self.get_image_blocks(pixel_array, block_size)
+        return blocks.mean(axis=(2, 3), dtype=np.float64)
+
+    def get_pixel_colours(self, image):
+        """
+        Gets the colour matrix for each pixel of an image, and returns an array of colour matrices.
+        Each sub-array corresponds to a row of pixels in the original image.
+
+        :param image: Image for which to retrieve the colour values.
+        :return: An array of arrays of RGB colour matrices, where each matrix = one pixel.
         """
 
         pixel_array = []
@@ -326,6 +1899,1007 @@ class MosaicCreator:
         return pixel_array
 
 
+class MosaicMetrics:
+    """
+    Collects named timing spans and counters while a collage is made.
+    Each span records wall time, CPU time of this process and of finished child processes, and the peak resident
+    memory while the span was open. Spans can nest.
+    Callbacks added with add_callback receive every finished span as a dictionary, so a job runner can collect
+    metrics without parsing the printed progress messages. Everything is also available from as_dict / to_json.
+    Recording a span costs a few system calls, so metrics are always on.
+    """
+
+    def __init__(self, callbacks=None):
+        """
+        :param callbacks: Functions called with a dictionary describing each finished span.
+        """
+
+        self.callbacks = list(callbacks or [])
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.open_spans = []
+
+    def __getstate__(self):
+        # Locks and callbacks cannot be sent to other processes
+        state = dict(self.__dict__)
+        del state['lock']
+        state['callbacks'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """
+        :param callback: Function called with a dictionary describing each finished span.
+        """
+
+        self.callbacks.append(callback)
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter. Safe to call from the matching threads.
+
+        :param name: Name of the counter.
+        :param amount: Amount to add.
+        """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def span(self, name):
+        """
+        Times the code inside a with block.
+
+        :param name: Name of the span, usually the pipeline stage.
+        """
+
+        record = {'name': name, 'parent': self.open_spans[-1]['name'] if self.open_spans else None,
+                  'peak_rss': 0}
+        if self.open_spans:
+            # Resetting the peak below also loses the enclosing span's peak so far, so it is kept first
+            self.open_spans[-1]['peak_rss'] = max(self.open_spans[-1]['peak_rss'], get_peak_rss())
+        self.open_spans.append(record)
+        with self.lock:
+            counters_before = dict(self.counters)
+        reset_peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child_cpu = get_child_cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['child_cpu'] = get_child_cpu_time() - child_cpu
+            # Nested spans reset the peak, so their peaks are passed up to the enclosing span
+            record['peak_rss'] = max(record['peak_rss'], get_peak_rss())
+            with self.lock:
+                counters_after = dict(self.counters)
+            record['counters'] = {counter: value - counters_before.get(counter, 0)
+                                  for counter, value in counters_after.items()
+                                  if value != counters_before.get(counter, 0)}
+            self.open_spans.pop()
+            if self.open_spans:
+                self.open_spans[-1]['peak_rss'] = max(self.open_spans[-1]['peak_rss'], record['peak_rss'])
+            self.spans.append(record)
+            for callback in self.callbacks:
+                callback(dict(record, type='span'))
+
+    def as_dict(self):
+        """
+        :return: All finished spans and the current counters.
+        """
+
+        return {'spans': list(self.spans), 'counters': dict(self.counters)}
+
+    def to_json(self):
+        """
+        :return: as_dict, as a JSON string.
+        """
+
+        return json.dumps(self.as_dict())
+
+
+def get_child_cpu_time():
+    """Gets the CPU time used by finished child processes, such as the micro-image ingest pool."""
+
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    """Resets the kernel's peak resident memory counter for this process, where supported (Linux)."""
+
+    try:
+        with io.open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def get_current_rss():
+    """Gets the resident memory of this process in bytes right now, where supported (Linux), otherwise its peak."""
+
+    try:
+        with io.open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    """
+    Gets the peak resident memory of this process in bytes, since the last reset_peak_rss where supported, otherwise
+    since the process started.
+    """
+
+    try:
+        with io.open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class AssignmentGrid:
+    """
+    The result of matching: which micro-image goes in each block of the collage, as a compact array of micro-image
+    numbers plus a manifest of the micro-images those numbers refer to.
+    It can be saved and rendered later, on another machine, or with a different micro-image size.
+    """
+
+    def __init__(self, tile_ids, manifest, block_size, main_size, tile_side=None, colours=None):
+        """
+        :param tile_ids: A rows x columns array of indices into the manifest.
+        :param manifest: Array of micro-images, as paths (or images, though those cannot be saved).
+        :param block_size: Block size the main image was matched with.
+        :param main_size: (width, height) of the main image.
+        :param tile_side: Side length of the micro-images the collage was matched for, if known.
+        :param colours: The pixels of the main image covered by blocks, as a uint8 array, to blend the micro-images
+                        toward when rendering with MosaicCreator.alpha_adjustment. None if the collage is not blended.
+        """
+
+        dtype = np.uint16 if len(manifest) <= 2 ** 16 else np.uint32
+        self.tile_ids = np.asarray(tile_ids, dtype=dtype)
+        self.manifest = list(manifest)
+        self.block_size = block_size
+        self.main_size = tuple(main_size)
+        self.tile_side = tile_side
+        self.colours = colours
+
+    def get_image_array(self, region=None):
+        """
+        :param region: (first row, end row, first column, end column) of the part of the grid to get, in blocks. None
+                       gets the whole grid.
+        :return: A rows x columns array of manifest entries, in the format returned by find_closest_image.
+        """
+
+        tile_ids = self.tile_ids
+        if region is not None:
+            first_row, end_row, first_column, end_column = region
+            tile_ids = tile_ids[first_row:end_row, first_column:end_column]
+        return [[self.manifest[tile_id] for tile_id in row] for row in tile_ids.tolist()]
+
+    def save(self, file_path):
+        """
+        Saves the assignment to a .npz file. The micro-image numbers, and the main image's colours if any, are saved
+        next to it as .npy files (see get_array_path), so that they can be memory-mapped and sliced without reading
+        the rest.
+
+        :param file_path: Path of the file to write, ending in .npz.
+        """
+
+        if not all(isinstance(image, str) for image in self.manifest):
+            raise ValueError("Only assignments of micro-image paths can be saved")
+        np.savez_compressed(file_path, manifest=np.array(self.manifest), block_size=self.block_size,
+                            main_size=np.array(self.main_size), tile_side=self.tile_side or 0,
+                            has_colours=self.colours is not None)
+        np.save(self.get_array_path(file_path, 'tile_ids'), self.tile_ids)
+        if self.colours is not None:
+            np.save(self.get_array_path(file_path, 'colours'), self.colours)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Loads an assignment saved with save. The micro-image numbers and colours are memory-mapped, so only the parts
+        that are rendered are read.
+
+        :param file_path: Path of the .npz file.
+        :return: The AssignmentGrid.
+        """
+
+        with np.load(file_path) as saved:
+            colours = None
+            if 'has_colours' in saved.files and bool(saved['has_colours']):
+                colours = np.load(cls.get_array_path(file_path, 'colours'), mmap_mode='r')
+            if 'tile_ids' in saved.files:
+                tile_ids = saved['tile_ids']
+            else:
+                tile_ids = np.load(cls.get_array_path(file_path, 'tile_ids'), mmap_mode='r')
+            return cls(tile_ids, [str(image) for image in saved['manifest']], int(saved['block_size']),
+                       tuple(int(size) for size in saved['main_size']), int(saved['tile_side']) or None, colours)
+
+    @staticmethod
+    def get_array_path(file_path, name):
+        """
+        :param file_path: Path of a saved assignment.
+        :param name: 'tile_ids' or 'colours'.
+        :return: Path of the .npy file that array of the assignment is saved to.
+        """
+
+        if file_path.endswith(".npz"):
+            file_path = file_path[:-len(".npz")]
+        return file_path + "." + name + ".npy"
+
+
+class ConstrainedAssigner:
+    """
+    Assigns micro-images to blocks subject to MosaicCreator.max_tile_uses and MosaicCreator.min_repeat_distance.
+    Each block's closest micro-images are listed in order of difference. Blocks then take turns through a priority
+    queue ordered by how much worse than its best match a block's next choice is, so blocks that have little to lose
+    give way to those that have a lot. Blocks which cannot take any of their listed micro-images are repaired together
+    once the queue empties: each is given its next closest micro-images among those still under max_uses, in chunked
+    distance matrices, and queued again. Each block is only queued once per choice it tries, so this stays close to
+    linear in the number of blocks.
+    """
+
+    def __init__(self, mosaic_creator, tile_features):
+        """
+        :param mosaic_creator: The MosaicCreator whose constraints, metric and distance calculation are used.
+        :param tile_features: Micro-image features, already passed through MosaicCreator.prepare_features.
+        """
+
+        self.mosaic_creator = mosaic_creator
+        self.tile_features = tile_features
+        self.max_uses = mosaic_creator.max_tile_uses or math.inf
+        self.radius = max(0, mosaic_creator.min_repeat_distance - 1)  # Blocks either side that must differ
+        tile_count = len(tile_features)
+        self.candidate_count = min(mosaic_creator.constraint_candidates or tile_count, tile_count)
+
+    def get_candidates(self, block_features):
+        """
+        Lists the closest micro-images to each block, closest first. Ties go to the lowest micro-image index, as in a
+        full search.
+
+        :param block_features: Prepared block features.
+        :return: (number of blocks, candidate_count) arrays of the differences and of the micro-image indices.
+        """
+
+        tile_count = len(self.tile_features)
+        chunk_size = self.mosaic_creator.match_chunk_size or max(1, MATCH_CHUNK_BYTES // (tile_count * 8 * 3))
+        costs = np.empty((len(block_features), self.candidate_count))
+        candidates = np.empty((len(block_features), self.candidate_count), dtype=np.intp)
+
+        def list_chunk(start):
+            distances = self.mosaic_creator.get_distance_matrix(block_features[start:start + chunk_size],
+                                                                self.tile_features)
+            if self.candidate_count < tile_count:
+                closest = np.argpartition(distances, self.candidate_count - 1, axis=1)[:, :self.candidate_count]
+                closest.sort(axis=1)
+            else:
+                closest = np.broadcast_to(np.arange(tile_count), distances.shape)
+            closest_costs = np.take_along_axis(distances, closest, axis=1)
+            order = np.argsort(closest_costs, axis=1, kind='stable')
+            candidates[start:start + chunk_size] = np.take_along_axis(closest, order, axis=1)
+            costs[start:start + chunk_size] = np.take_along_axis(closest_costs, order, axis=1)
+
+        self.mosaic_creator.run_parallel(list_chunk, range(0, len(block_features), chunk_size))
+        return costs, candidates
+
+    def assign(self, block_features, grid_shape):
+        """
+        Chooses a micro-image for every block, and reports how much closer the collage would be without the
+        constraints.
+
+        :param block_features: Prepared block features, in row order.
+        :param grid_shape: Rows and columns of blocks.
+        :return: A 1D array with the index of the micro-image chosen for each block.
+        """
+
+        if self.max_uses * len(self.tile_features) < len(block_features):
+            raise ValueError("%d micro-images used at most %d times each cannot fill %d blocks"
+                             % (len(self.tile_features), self.max_uses, len(block_features)))
+
+        costs, candidates = self.get_candidates(block_features)
+        cost_lists = costs.tolist()
+        candidate_lists = candidates.tolist()
+        columns = grid_shape[1]
+        # Plain lists are much quicker than NumPy for the many tiny lookups here. The rows are padded by the repeat
+        # radius on every side so that nearby blocks can be sliced without bounds checks
+        self.assigned = [[-1] * (columns + 2 * self.radius) for _ in range(grid_shape[0] + 2 * self.radius)]
+        self.uses = [0] * len(self.tile_features)
+        chosen_costs = np.empty(len(block_features))
+
+        # Every block starts on its best match, 0 worse than its best, in block order, which is already a valid heap
+        queue = [(0.0, block, 0) for block in range(len(block_features))]
+        repaired = np.zeros(len(block_features), dtype=bool)
+        violations = 0
+        repair_count = self.candidate_count
+        while queue:
+            exhausted = []
+            while queue:
+                _, block, rank = heapq.heappop(queue)
+                tile = candidate_lists[block][rank]
+                if self.is_allowed(tile, block // columns, block % columns):
+                    self.place(tile, block // columns, block % columns)
+                    chosen_costs[block] = cost_lists[block][rank]
+                    continue
+                # Micro-images at max_uses never become free again, so the block skips them rather than queueing again
+                candidate_list = candidate_lists[block]
+                rank += 1
+                while rank < len(candidate_list) and self.uses[candidate_list[rank]] >= self.max_uses:
+                    rank += 1
+                if rank < len(candidate_list):
+                    heapq.heappush(queue, (cost_lists[block][rank] - cost_lists[block][0], block, rank))
+                else:
+                    exhausted.append(block)
+
+            if exhausted:
+                repaired[exhausted] = True
+                requeued, placed_too_close = self.repair(block_features, exhausted, cost_lists, candidate_lists,
+                                                         chosen_costs, repair_count)
+                violations += placed_too_close
+                # Blocks still unplaced after a repair are competing for few micro-images, so each repair lists twice
+                # as many, which keeps the number of repairs logarithmic in the number of micro-images
+                repair_count *= 2
+                queue = [(cost_lists[block][rank] - cost_lists[block][0], block, rank) for block, rank in requeued]
+                heapq.heapify(queue)
+
+        matches = np.array([row[self.radius:self.radius + columns]
+                            for row in self.assigned[self.radius:self.radius + grid_shape[0]]], dtype=np.intp).ravel()
+        best_cost = costs[:, 0].sum()
+        moved = int((matches != candidates[:, 0]).sum())
+        self.mosaic_creator.metrics.count('constraint_blocks_moved', moved)
+        self.mosaic_creator.metrics.count('constraint_repairs', int(repaired.sum()))
+        self.mosaic_creator.metrics.count('repeat_distance_violations', violations)
+        self.mosaic_creator.metrics.count('constraint_cost_increase', float(chosen_costs.sum() - best_cost))
+        print("Constraints moved", moved, "of", len(matches), "blocks off their closest micro-image, total difference",
+              "%.1f%%" % (100 * (chosen_costs.sum() / best_cost - 1) if best_cost else 0.0), "higher")
+        return matches
+
+    def repair(self, block_features, blocks, cost_lists, candidate_lists, chosen_costs, count):
+        """
+        Extends the candidate lists of blocks which could not take any of their listed micro-images with their next
+        closest micro-images, among those still under max_uses that they have not tried yet.
+        The blocks are compared against those micro-images in chunks, as in get_candidates.
+        A block which has tried every micro-image under max_uses cannot meet both constraints, so it is given the
+        closest of them straight away, even though it repeats too close by.
+
+        :param block_features: Prepared block features.
+        :param blocks: Indices of the blocks to extend.
+        :param cost_lists: Differences of each block's candidates, extended in place.
+        :param candidate_lists: Each block's candidates, extended in place.
+        :param chosen_costs: Difference of each block to its chosen micro-image, filled in for blocks placed here.
+        :param count: Number of micro-images to add to each list.
+        :return: A list of (block, rank of its first new candidate) to queue again, and the number of blocks placed too
+                 close to a repeat.
+        """
+
+        columns = len(self.assigned[0]) - 2 * self.radius
+        available = np.flatnonzero(np.array(self.uses) < self.max_uses)
+        available_column = np.full(len(self.tile_features), -1, dtype=np.intp)
+        available_column[available] = np.arange(len(available))
+        available_features = self.tile_features[available]
+        count = min(count, len(available))
+        chunk_size = self.mosaic_creator.match_chunk_size or max(1, MATCH_CHUNK_BYTES // (len(available) * 8 * 3))
+        requeued = []
+        violations = 0
+        for start in range(0, len(blocks), chunk_size):
+            chunk = blocks[start:start + chunk_size]
+            distances = self.mosaic_creator.get_distance_matrix(block_features[chunk], available_features)
+            # Micro-images a block has tried were rejected, and placing more blocks only ever rejects more
+            tried_rows = np.repeat(np.arange(len(chunk)), [len(candidate_lists[block]) for block in chunk])
+            tried_columns = available_column[np.concatenate([candidate_lists[block] for block in chunk])]
+            tried = tried_columns >= 0
+            closest_available = distances.argmin(axis=1)
+            distances[tried_rows[tried], tried_columns[tried]] = np.inf
+
+            if count < len(available):
+                closest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+                closest.sort(axis=1)
+            else:
+                closest = np.broadcast_to(np.arange(len(available)), distances.shape)
+            closest_costs = np.take_along_axis(distances, closest, axis=1)
+            order = np.argsort(closest_costs, axis=1, kind='stable')
+            closest = available[np.take_along_axis(closest, order, axis=1)]
+            closest_costs = np.take_along_axis(closest_costs, order, axis=1)
+
+            for block, tiles, costs, fallback in zip(chunk, closest.tolist(), closest_costs.tolist(),
+                                                     available[closest_available].tolist()):
+                untried = [index for index, cost in enumerate(costs) if cost != math.inf]
+                if untried:
+                    requeued.append((block, len(candidate_lists[block])))
+                    candidate_lists[block].extend(tiles[index] for index in untried)
+                    cost_lists[block].extend(costs[index] for index in untried)
+                    continue
+                if self.uses[fallback] >= self.max_uses:
+                    # Filled by an earlier block in this repair, so the closest one left is searched for
+                    distances = self.mosaic_creator.get_distance_matrix(block_features[block:block + 1],
+                                                                        self.tile_features)[0]
+                    fallback = next(tile for tile in np.argsort(distances, kind='stable').tolist()
+                                    if self.uses[tile] < self.max_uses)
+                self.place(fallback, block // columns, block % columns)
+                chosen_costs[block] = self.mosaic_creator.get_distance_matrix(
+                    block_features[block:block + 1], self.tile_features[fallback:fallback + 1])[0, 0]
+                violations += 1
+        return requeued, violations
+
+    def is_allowed(self, tile, row, column):
+        """
+        :return: Whether the micro-image can be placed at the block without breaking either constraint.
+        """
+
+        if self.uses[tile] >= self.max_uses:
+            return False
+        for nearby_row in self.assigned[row:row + 2 * self.radius + 1]:
+            if tile in nearby_row[column:column + 2 * self.radius + 1]:
+                return False
+        return True
+
+    def place(self, tile, row, column):
+        self.assigned[row + self.radius][column + self.radius] = tile
+        self.uses[tile] += 1
+
+
+class TileIndex:
+    """
+    Bucketed grid over the mean colour of each micro-image, used to avoid comparing every block against every
+    micro-image.
+
+    The difference between a block and a micro-image can never be smaller than the block's pixel count times the
+    difference between their mean colours, so once the closest micro-image found so far beats that lower bound for
+    every grid cell not yet searched, the search can stop.
+    Blocks are queried in batches, one batch per grid cell, searching outwards one ring of cells at a time.
+    Batches are spread over MosaicCreator.match_workers threads.
+    """
+
+    def __init__(self, mosaic_creator, tile_features):
+        """
+        :param mosaic_creator: The MosaicCreator whose metric and distance calculation are used.
+        :param tile_features: Micro-image features, already passed through MosaicCreator.prepare_features.
+        """
+
+        self.mosaic_creator = mosaic_creator
+        self.tile_features = tile_features
+        self.channels = 2 if mosaic_creator.metric == 'absolute' else 3
+        self.squared = mosaic_creator.metric in SQUARED_METRICS
+        self.levels = mosaic_creator.index_grid_levels
+        self.cell_width = 256 / self.levels
+
+        tile_cells = self.get_cells(self.get_means(tile_features))
+        tile_keys = np.ravel_multi_index(tile_cells.T, (self.levels,) * self.channels)
+        self.tile_order = np.argsort(tile_keys, kind='stable')
+        self.cell_keys, self.cell_starts = np.unique(tile_keys[self.tile_order], return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(tile_keys))
+        self.cells = np.array(np.unravel_index(self.cell_keys, (self.levels,) * self.channels)).T
+
+    def get_means(self, features):
+        """
+        :param features: Prepared features, (N, feature length).
+        :return: The mean colour of each feature vector, (N, channels).
+        """
+
+        return features.reshape(len(features), -1, self.channels).mean(axis=1)
+
+    def get_cells(self, means):
+        """
+        :param means: Mean colours, (N, channels).
+        :return: The grid cell co-ordinates of each colour, (N, channels).
+        """
+
+        return np.clip((means // self.cell_width).astype(np.intp), 0, self.levels - 1)
+
+    def query(self, block_features, epsilon=0.0):
+        """
+        Finds the closest micro-image to every block.
+
+        :param block_features: Prepared block features, (number of blocks, feature length).
+        :param epsilon: 0 for an exact search. Otherwise the difference of each match is at most (1 + epsilon) times
+                        the smallest possible difference, which lets the search stop sooner.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        means = self.get_means(block_features)
+        block_cells = self.get_cells(means)
+        block_keys = np.ravel_multi_index(block_cells.T, (self.levels,) * self.channels)
+        block_order = np.argsort(block_keys, kind='stable')
+        group_keys, group_starts = np.unique(block_keys[block_order], return_index=True)
+        group_ends = np.append(group_starts[1:], len(block_keys))
+
+        matches = np.empty(len(block_features), dtype=np.intp)
+
+        def query_group(group):
+            blocks = block_order[group[0]:group[1]]
+            matches[blocks] = self.query_cell(block_features[blocks], means[blocks], block_cells[blocks[0]], epsilon)
+
+        self.mosaic_creator.run_parallel(query_group, zip(group_starts, group_ends))
+        return matches
+
+    def query_cell(self, block_features, means, cell, epsilon):
+        """
+        Searches outwards from one grid cell for the closest micro-images to the blocks which fall into that cell.
+
+        :param block_features: Prepared features of the blocks in the cell.
+        :param means: Mean colours of the blocks in the cell.
+        :param cell: Grid co-ordinates of the cell.
+        :param epsilon: See query.
+        :return: The index of the closest micro-image for each block.
+        """
+
+        pixel_count = block_features.shape[1] // self.channels
+        best_distances = np.full(len(block_features), np.inf)
+        best_indices = np.full(len(block_features), -1, dtype=np.intp)
+        pending = np.arange(len(block_features))
+        ring_distances = np.abs(self.cells - cell).max(axis=1)
+
+        radius = 0
+        while len(pending):
+            ring = np.flatnonzero(ring_distances == radius)
+            if len(ring):
+                candidates = np.concatenate([self.tile_order[self.cell_starts[i]:self.cell_ends[i]] for i in ring])
+                self.update_best(block_features, pending, candidates, best_distances, best_indices)
+
+            low = cell - radius
+            high = cell + radius
+            if (low <= 0).all() and (high >= self.levels - 1).all():
+                break
+
+            # Smallest mean colour difference to any micro-image outside of the cells searched so far
+            below = np.where(low > 0, means[pending] - low * self.cell_width, np.inf)
+            above = np.where(high < self.levels - 1, (high + 1) * self.cell_width - means[pending], np.inf)
+            gap = np.maximum(np.minimum(below, above).min(axis=1), 0)
+            lower_bound = pixel_count * (gap * gap if self.squared else gap)
+
+            pending = pending[best_distances[pending] > lower_bound * (1 + epsilon)]
+            radius += 1
+        return best_indices
+
+    def update_best(self, block_features, pending, candidates, best_distances, best_indices):
+        """
+        Compares the pending blocks against the candidate micro-images, keeping the closest found so far.
+        Ties go to the lowest micro-image index, the same as a full search.
+        """
+
+        candidates = np.sort(candidates)
+        chunk_size = self.mosaic_creator.get_match_chunk_size(len(candidates))
+        for start in range(0, len(pending), chunk_size):
+            blocks = pending[start:start + chunk_size]
+            distances = self.mosaic_creator.get_distance_matrix(block_features[blocks],
+                                                                self.tile_features[candidates])
+            closest = distances.argmin(axis=1)
+            closest_distances = distances[np.arange(len(blocks)), closest]
+            closest_indices = candidates[closest]
+            better = (closest_distances < best_distances[blocks]) | \
+                     ((closest_distances == best_distances[blocks]) & (closest_indices < best_indices[blocks]))
+            best_distances[blocks[better]] = closest_distances[better]
+            best_indices[blocks[better]] = closest_indices[better]
+
+
+class MatchCache:
+    """
+    Least recently used cache of matches, keyed by the prepared features of a block divided by
+    MosaicCreator.match_cache_step and rounded down. Blocks with the same key, whether in one collage or in later
+    collages matched against the same micro-images, are searched for once and share the result.
+    Hits and misses are counted in MosaicCreator.metrics as match_cache_hits and match_cache_misses.
+    """
+
+    def __init__(self, mosaic_creator):
+        """
+        :param mosaic_creator: The MosaicCreator whose match_cache_step, match_cache_size and metrics are used.
+        """
+
+        self.mosaic_creator = mosaic_creator
+        self.step = mosaic_creator.match_cache_step
+        self.capacity = max(1, mosaic_creator.match_cache_size)
+        self.matches = OrderedDict()
+        self.tile_features = None  # Matches are only valid for the micro-image features they were found in
+        self.hits = 0
+        self.misses = 0
+
+    def get_keys(self, block_features):
+        """
+        :param block_features: Prepared block features, (number of blocks, feature length).
+        :return: A 1D array with the quantised signature of each block, as raw bytes.
+        """
+
+        quantised = np.ascontiguousarray(np.floor(block_features / self.step).astype(np.int32))
+        return quantised.view(np.dtype((np.void, quantised.shape[1] * quantised.itemsize))).ravel()
+
+    def match(self, block_features, tile_features, search):
+        """
+        Finds the closest micro-image for every block, only searching for blocks whose key has not been seen.
+
+        :param block_features: Prepared block features.
+        :param tile_features: Prepared micro-image features.
+        :param search: Function taking prepared block features and returning the index of the closest micro-image for
+                       each of them.
+        :return: A 1D array with the index of the closest micro-image for each block.
+        """
+
+        if tile_features is not self.tile_features:
+            self.matches.clear()
+            self.tile_features = tile_features
+
+        keys, first_blocks, inverse = np.unique(self.get_keys(block_features), return_index=True,
+                                                return_inverse=True)
+        unique_matches = np.empty(len(keys), dtype=np.intp)
+        missing = []
+        for position, key in enumerate(keys):
+            match = self.matches.get(key.tobytes())
+            if match is None:
+                missing.append(position)
+            else:
+                self.matches.move_to_end(key.tobytes())
+                unique_matches[position] = match
+
+        if missing:
+            # Near-identical blocks all take the match of the first of them in the image
+            unique_matches[missing] = search(block_features[first_blocks[missing]])
+            for position in missing:
+                self.matches[keys[position].tobytes()] = unique_matches[position]
+            while len(self.matches) > self.capacity:
+                self.matches.popitem(last=False)
+
+        self.hits += len(block_features) - len(missing)
+        self.misses += len(missing)
+        self.mosaic_creator.metrics.count('match_cache_hits', len(block_features) - len(missing))
+        self.mosaic_creator.metrics.count('match_cache_misses', len(missing))
+        return unique_matches[inverse.ravel()]
+
+
+class MicroImageCache:
+    """
+    Least recently used cache of resized micro-images for the paste stage, bounded by
+    MosaicCreator.micro_image_cache_bytes. Micro-images are only decoded once they are actually used in the collage.
+    """
+
+    def __init__(self, mosaic_creator, tile_side):
+        """
+        :param mosaic_creator: The MosaicCreator used to load and resize micro-images.
+        :param tile_side: Side length of every micro-image in the collage.
+        """
+
+        self.mosaic_creator = mosaic_creator
+        self.tile_side = tile_side
+        # PIL keeps RGB images at 4 bytes a pixel
+        self.capacity = max(1, mosaic_creator.micro_image_cache_bytes // (tile_side * tile_side * 4))
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image):
+        """
+        Gets the resized micro-image for one entry of the collage.
+
+        :param image: An entry from the output of find_closest_image, either an image or the path to a micro-image.
+        :return: The resized micro-image.
+        """
+
+        if isinstance(image, Image.Image):
+            return image
+        if image in self.images:
+            self.hits += 1
+            self.images.move_to_end(image)
+            return self.images[image]
+
+        self.misses += 1
+        self.mosaic_creator.metrics.count('micro_images_decoded_for_paste')
+        loaded_image = self.mosaic_creator.prepare_micro_image(image, self.tile_side)
+        self.images[image] = loaded_image
+        if len(self.images) > self.capacity:
+            self.images.popitem(last=False)
+        return loaded_image
+
+
+class TileAtlas:
+    """
+    Every resized micro-image of a collage in one (number of micro-images, side, side, 3) uint8 array, memory-mapped
+    read-only from the .npy file written by MosaicCreator.build_tile_atlas. Micro-images are slices of the mapping, so
+    nothing is decoded or copied to paste them, and any number of processes rendering from the same atlas share one
+    copy of it through the operating system's page cache.
+    Used in place of a MicroImageCache.
+    """
+
+    def __init__(self, atlas_path):
+        """
+        :param atlas_path: Path of the .npy file. Its description must be next to it, as <atlas_path>.json.
+        """
+
+        self.atlas_path = atlas_path
+        self.tiles = np.load(atlas_path, mmap_mode='r')
+        with io.open(atlas_path + ".json") as description_file:
+            description = json.load(description_file)
+        self.tile_side = description['tile_side']
+        self.index = {image_path: index for index, image_path in enumerate(description['paths'])}
+        self.hits = 0
+        self.misses = 0  # Always 0, nothing is decoded
+
+    def __getstate__(self):
+        # Each process maps the file itself rather than receiving a copy of the array
+        return self.atlas_path
+
+    def __setstate__(self, atlas_path):
+        self.__init__(atlas_path)
+
+    def get(self, image):
+        """
+        Gets the resized micro-image for one entry of the collage.
+
+        :param image: An entry from the output of find_closest_image, either an image or the path to a micro-image.
+        :return: The resized micro-image, as a read-only view of the atlas.
+        """
+
+        if isinstance(image, Image.Image):
+            return image
+        self.hits += 1
+        return self.tiles[self.index[path.abspath(image)]]
+
+    def get_tiles(self, images):
+        """
+        :param images: Array of paths to micro-images.
+        :return: The resized micro-images, as a single (len(images), side, side, 3) array gathered from the atlas.
+        """
+
+        self.hits += len(images)
+        return self.tiles[[self.index[path.abspath(image)] for image in images]]
+
+
+class TiffStripWriter:
+    """
+    Writes an uncompressed 8-bit RGB TIFF one horizontal strip at a time, so the full image never needs to be in
+    memory. The strips are written first and the image directory last, once every strip offset is known.
+    Files that would not fit in 4GB are written as BigTIFF.
+    """
+
+    SHORT = 3
+    LONG = 4
+    RATIONAL = 5
+    LONG8 = 16
+
+    def __init__(self, file_path, width, height, big_tiff=None):
+        """
+        :param file_path: Path of the TIFF to write.
+        :param width: Width of the image, in pixels.
+        :param height: Height of the image, in pixels.
+        :param big_tiff: Whether to write a BigTIFF. None = only if the file would not fit in 4GB.
+        """
+
+        self.width = width
+        self.height = height
+        # Leave some room for the image directory and the strip offset tables after the pixel data
+        if big_tiff is None:
+            big_tiff = width * height * 3 + (height + 1024) * 16 >= 2 ** 32
+        self.big_tiff = big_tiff
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.rows_per_strip = None
+        self.rows_written = 0
+
+        self.file = io.open(file_path, 'wb')
+        if self.big_tiff:
+            self.file.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+        else:
+            self.file.write(struct.pack('<2sHI', b'II', 42, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write_strip(self, pixels):
+        """
+        Appends rows to the image. Every strip except the last must have the same number of rows.
+
+        :param pixels: A rows x width x 3 uint8 array.
+        """
+
+        if pixels.shape[1:] != (self.width, 3):
+            raise ValueError("Strip must be rows x %d x 3, got %s" % (self.width, pixels.shape))
+        if self.rows_per_strip is None:
+            self.rows_per_strip = pixels.shape[0]
+        elif self.strip_byte_counts[-1] != self.rows_per_strip * self.width * 3:
+            raise ValueError("Only the last strip may be shorter than the others")
+        elif pixels.shape[0] > self.rows_per_strip:
+            raise ValueError("Strip has more rows than the first strip")
+
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(pixels.nbytes)
+        self.file.write(np.ascontiguousarray(pixels, dtype=np.uint8))
+        self.rows_written += pixels.shape[0]
+
+    def close(self):
+        """
+        Writes the image directory and closes the file.
+        """
+
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError("Wrote %d rows of a %d row image" % (self.rows_written, self.height))
+
+        offset_type = self.LONG8 if self.big_tiff else self.LONG
+        entries = [
+            (256, self.LONG, [self.width]),  # ImageWidth
+            (257, self.LONG, [self.height]),  # ImageLength
+            (258, self.SHORT, [8, 8, 8]),  # BitsPerSample
+            (259, self.SHORT, [1]),  # Compression: none
+            (262, self.SHORT, [2]),  # PhotometricInterpretation: RGB
+            (273, offset_type, self.strip_offsets),  # StripOffsets
+            (277, self.SHORT, [3]),  # SamplesPerPixel
+            (278, self.LONG, [self.rows_per_strip or self.height]),  # RowsPerStrip
+            (279, offset_type, self.strip_byte_counts),  # StripByteCounts
+            (282, self.RATIONAL, [72, 1]),  # XResolution
+            (283, self.RATIONAL, [72, 1]),  # YResolution
+            (284, self.SHORT, [1]),  # PlanarConfiguration: contiguous
+            (296, self.SHORT, [2]),  # ResolutionUnit: inch
+        ]
+        if self.big_tiff:
+            count_format, entry_format, offset_format, inline_size = '<Q', '<HHQ', '<Q', 8
+        else:
+            count_format, entry_format, offset_format, inline_size = '<H', '<HHI', '<I', 4
+        value_formats = {self.SHORT: 'H', self.LONG: 'I', self.RATIONAL: 'I', self.LONG8: 'Q'}
+
+        # Word align the directory, then place any values too big to fit in their entry straight after it
+        directory_offset = self.file.tell() + self.file.tell() % 2
+        entry_size = struct.calcsize(entry_format) + inline_size
+        extra_offset = directory_offset + struct.calcsize(count_format) + len(entries) * entry_size + inline_size
+        directory = struct.pack(count_format, len(entries))
+        extra = b''
+        for tag, value_type, values in entries:
+            packed = struct.pack('<%d%s' % (len(values), value_formats[value_type]), *values)
+            count = len(values) // 2 if value_type == self.RATIONAL else len(values)
+            directory += struct.pack(entry_format, tag, value_type, count)
+            if len(packed) <= inline_size:
+                directory += packed.ljust(inline_size, b'\0')
+            else:
+                directory += struct.pack(offset_format, extra_offset + len(extra))
+                extra += packed + b'\0' * (len(packed) % 2)
+        directory += struct.pack(offset_format, 0)
+
+        self.file.seek(directory_offset)
+        self.file.write(directory + extra)
+        self.file.seek(8 if self.big_tiff else 4)
+        self.file.write(struct.pack(offset_format, directory_offset))
+        self.file.close()
+
+
+class DeepZoomWriter:
+    """
+    Writes a Deep Zoom (DZI) tile pyramid one horizontal strip at a time, for zoomable viewers such as OpenSeadragon.
+    Each level holds at most one row of tiles. Once a level has a full row it is saved as tiles, then halved and passed
+    on to the next level down, so lower levels are built from the tiles above them rather than from the full image,
+    which never needs to be in memory.
+    """
+
+    def __init__(self, file_path, width, height, tile_size=256, tile_format='jpg'):
+        """
+        :param file_path: Path of the .dzi file to write. Tiles are written to a folder next to it, ending in _files.
+        :param width: Width of the full resolution image, in pixels.
+        :param height: Height of the full resolution image, in pixels.
+        :param tile_size: Width and height of each tile, in pixels. Must be even.
+        :param tile_format: 'jpg' or 'png'.
+        """
+
+        if tile_size % 2:
+            raise ValueError("tile_size must be even")
+        self.file_path = file_path
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.tile_folder = path.splitext(file_path)[0] + "_files"
+        # Level 0 is a single pixel, each level after it doubles in size up to the full image
+        self.max_level = math.ceil(math.log2(max(width, height, 1)))
+        self.bands = [[] for _ in range(self.max_level + 1)]  # Rows of each level not yet saved as tiles
+        self.tile_rows = [0] * (self.max_level + 1)  # Rows of tiles saved for each level
+        self.rows_written = 0
+        for level in range(self.max_level + 1):
+            makedirs(path.join(self.tile_folder, str(level)), exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write_strip(self, pixels):
+        """
+        Appends rows to the full resolution image. Strips may have any number of rows.
+
+        :param pixels: A rows x width x 3 uint8 array.
+        """
+
+        if pixels.shape[1:] != (self.width, 3):
+            raise ValueError("Strip must be rows x %d x 3, got %s" % (self.width, pixels.shape))
+        self.rows_written += pixels.shape[0]
+        self.add_rows(self.max_level, pixels)
+
+    def add_rows(self, level, pixels):
+        """
+        Adds rows to a level, saving each row of tiles as soon as it is complete.
+
+        :param level: The level to add to.
+        :param pixels: A rows x level width x 3 uint8 array.
+        """
+
+        band = self.bands[level]
+        band.append(pixels)
+        if sum(len(rows) for rows in band) < self.tile_size:
+            return
+        pixels = np.concatenate(band)
+        while len(pixels) >= self.tile_size:
+            self.write_tile_row(level, pixels[:self.tile_size])
+            pixels = pixels[self.tile_size:]
+        self.bands[level] = [pixels] if len(pixels) else []
+
+    def write_tile_row(self, level, pixels):
+        """
+        Saves one row of tiles of a level, and passes it on halved to the level below.
+
+        :param level: The level of the row.
+        :param pixels: A rows x level width x 3 uint8 array, no more than tile_size rows.
+        """
+
+        folder = path.join(self.tile_folder, str(level))
+        for column, x in enumerate(range(0, pixels.shape[1], self.tile_size)):
+            tile = Image.fromarray(np.ascontiguousarray(pixels[:, x:x + self.tile_size]))
+            tile.save(path.join(folder, "%d_%d.%s" % (column, self.tile_rows[level], self.tile_format)))
+        self.tile_rows[level] += 1
+        if level > 0:
+            self.add_rows(level - 1, self.halve(pixels))
+
+    def halve(self, pixels):
+        """
+        Halves the width and height of some rows by averaging each 2x2 square of pixels. An odd last row or column is
+        averaged with itself, so a level is always the ceiling of half the level above.
+
+        :param pixels: A rows x width x 3 uint8 array.
+        :return: The halved rows.
+        """
+
+        if len(pixels) % 2:
+            pixels = np.concatenate((pixels, pixels[-1:]))
+        if pixels.shape[1] % 2:
+            pixels = np.concatenate((pixels, pixels[:, -1:]), axis=1)
+        squares = pixels.reshape(len(pixels) // 2, 2, pixels.shape[1] // 2, 2, 3)
+        return ((squares.sum(axis=(1, 3), dtype=np.uint16) + 2) // 4).astype(np.uint8)
+
+    def close(self):
+        """
+        Saves the partial last row of tiles of every level, then writes the .dzi file describing the pyramid.
+        """
+
+        if self.rows_written != self.height:
+            raise ValueError("Wrote %d rows of a %d row image" % (self.rows_written, self.height))
+        for level in range(self.max_level, -1, -1):
+            if self.bands[level]:
+                pixels = np.concatenate(self.bands[level])
+                self.bands[level] = []
+                self.write_tile_row(level, pixels)
+
+        with io.open(self.file_path, 'w') as dzi_file:
+            dzi_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="%d" Overlap="0" '
+                           'Format="%s">\n  <Size Width="%d" Height="%d"/>\n</Image>\n'
+                           % (self.tile_size, self.tile_format, self.width, self.height))
+
+
 def list_directory(basepath):
     """Retrieves all java files in the directory and yields the full path"""
 
@@ -335,17 +2909,106 @@ def list_directory(basepath):
 
 
 def main():
-    start = time.process_time()
-    mosaic_creator = MosaicCreator(block_size=8, size_reduction_factor=1, alpha_adjustment=0.2)
+    parser = argparse.ArgumentParser(description="Creates a collage of each main image out of the micro-images.")
+    parser.add_argument('main_images', nargs='*', help="Main images, or folders of main images, to make collages of. "
+                                                       "Without any, the example image is used")
+    parser.add_argument('--micro-images', default=r"Source_Images/Micro_Images/Random_Images",
+                        help="Folder of micro-images")
+    parser.add_argument('--output-folder', default="Collages", help="Folder to save collages to in batch mode")
+    parser.add_argument('--block-size', type=int, default=8)
+    parser.add_argument('--size-reduction-factor', type=float, default=1)
+    parser.add_argument('--alpha-adjustment', type=float, default=0.2,
+                        help="How far, from 0 to 1, to blend each micro-image toward the colours it replaces")
+    parser.add_argument('--output-format', choices=('jpg', 'tiff', 'dzi'),
+                        help="Defaults to tiff with --incremental, otherwise jpg")
+    parser.add_argument('--metric', choices=MATCH_METRICS, default='absolute',
+                        help="How micro-images are compared to blocks, 'lab' matches colours most as they are seen")
+    parser.add_argument('--match-cache-step', type=float,
+                        help="Match blocks whose colours are equal to within this step only once")
+    parser.add_argument('--max-tile-uses', type=int, help="Use each micro-image at most this many times")
+    parser.add_argument('--min-repeat-distance', type=int, default=0,
+                        help="Blocks apart that the same micro-image must be, 2 stops identical micro-images touching")
+    parser.add_argument('--frames', action='store_true',
+                        help="Treat the main images as frames of a sequence, only re-matching blocks which change")
+    parser.add_argument('--save-assignment', action='store_true',
+                        help="Save which micro-image went in each block next to each collage, to render again later")
+    parser.add_argument('--render-assignment', metavar='FILE',
+                        help="Render a collage from a saved assignment instead of matching")
+    parser.add_argument('--tile-side', type=int, help="Micro-image size to render a saved assignment with")
+    parser.add_argument('--region-folder', help="Render a saved assignment as regions in this folder, using worker "
+                                                "processes, then stitch them into --output")
+    parser.add_argument('--region-size', type=int, default=16, help="Width and height of each region, in micro-images")
+    parser.add_argument('--output', help="Path to save a single collage to")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Overlap decoding, matching, rendering and writing instead of running them in turn")
+    parser.add_argument('--pipeline-depth', type=int, default=2,
+                        help="Bands each pipeline stage may run ahead of the next, bounding memory between stages")
+    parser.add_argument('--tile-atlas', metavar='FILE',
+                        help="Memory-mapped .npy atlas of resized micro-images to paste from, built when out of date")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="Choose micro-image size and worker counts so the job fits in this much memory, or stop "
+                             "before starting if it cannot")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only re-match and repaint blocks which changed since each collage was last made")
+    parser.add_argument('--change-threshold', type=float, default=4.0,
+                        help="Average colour change per pixel above which a block of a frame is matched again")
+    arguments = parser.parse_args()
 
-    mini_image_folder = r"Source_Images/Micro_Images/Random_Images"
-    big_image = r"Source_Images/Main_Images/Example.jpg"
+    start = time.process_time()
+    mini_image_folder = arguments.micro_images
+    mosaic_creator = MosaicCreator(block_size=arguments.block_size,
+                                   size_reduction_factor=arguments.size_reduction_factor,
+                                   alpha_adjustment=arguments.alpha_adjustment,
+                                   tile_cache_path=path.normpath(mini_image_folder) + ".mosaic_cache.npz",
+                                   output_format=arguments.output_format, incremental=arguments.incremental,
+                                   metric=arguments.metric, save_assignments=arguments.save_assignment,
+                                   match_cache_step=arguments.match_cache_step, max_tile_uses=arguments.max_tile_uses,
+                                   min_repeat_distance=arguments.min_repeat_distance,
+                                   tile_atlas_path=arguments.tile_atlas, pipeline=arguments.pipeline,
+                                   pipeline_depth=arguments.pipeline_depth)
+    if arguments.render_assignment and arguments.region_folder:
+        # Regions are stitched into a TIFF even when collages are otherwise saved as JPEGs
+        stitch_path = arguments.output or path.splitext(mosaic_creator.get_default_output_path())[0] + (
+            ".dzi" if mosaic_creator.output_format == 'dzi' else ".tif")
+        mosaic_creator.render_regions(arguments.render_assignment, arguments.region_folder, arguments.tile_side,
+                                      arguments.region_size, stitch_path=stitch_path)
+        return
+    if arguments.render_assignment:
+        mosaic_creator.render_assignment(arguments.render_assignment,
+                                         arguments.output or mosaic_creator.get_default_output_path(),
+                                         arguments.tile_side)
+        return
 
     mini_images = []
     for file in list_directory(mini_image_folder):
         mini_images.append(file)
 
-    mosaic_creator.create_mosaic(mini_images, big_image)
+    big_images = []
+    for main_image in arguments.main_images or [r"Source_Images/Main_Images/Example.jpg"]:
+        if path.isdir(main_image):
+            big_images.extend(sorted(list_directory(main_image)))
+        else:
+            big_images.append(main_image)
+
+    plan = None
+    if arguments.memory_budget:
+        plan = mosaic_creator.plan_job(mini_images, big_images, int(arguments.memory_budget * 2 ** 20))
+        mosaic_creator.apply_plan(plan)
+        print("Estimated peak memory", plan['peak_bytes'] // 2 ** 20, "MB, output about",
+              plan['output_bytes'] // 2 ** 20, "MB per collage")
+
+    if not arguments.main_images:
+        mosaic_creator.create_mosaic(mini_images, big_images[0], arguments.output)
+    else:
+        if arguments.frames:
+            mosaic_creator.create_frame_mosaics(mini_images, big_images, arguments.output_folder,
+                                                arguments.change_threshold)
+        else:
+            mosaic_creator.create_mosaics(mini_images, big_images, arguments.output_folder)
+    if plan:
+        measured = max([span['peak_rss'] for span in mosaic_creator.metrics.spans] or [get_peak_rss()])
+        print("Measured peak memory", measured // 2 ** 20, "MB against", plan['process_bytes'] // 2 ** 20,
+              "MB estimated for this process")
     time_taken = time.process_time() - start
     print("Completed in " + str(time_taken) + " seconds")
 
@@ -353,5 +3016,4 @@ def main():
 if __name__ == '__main__':
     main()
 
-# TODO: Add colour adjustment
 # TODO: Create UI
@@ -0,0 +1,155 @@
+"""
+Round-trip checks for the streamed writers, and checks that the faster matchers find the same micro-images as a
+full search. Run with python -m unittest test_converter (or pytest).
+"""
+
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+from os import makedirs, path
+
+import numpy as np
+from PIL import Image
+
+from Benchmark_Converter import make_synthetic_image
+from Updated_Converter import DeepZoomWriter, MosaicCreator, TiffStripWriter, list_directory
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='mosaic_test_')
+        self.pixels = np.random.default_rng(0).integers(0, 256, (300, 520, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_tiff(self, big_tiff):
+        file_path = path.join(self.directory, 'strips.tif')
+        with TiffStripWriter(file_path, self.pixels.shape[1], self.pixels.shape[0], big_tiff) as writer:
+            # The last strip is shorter than the others
+            for start in range(0, len(self.pixels), 64):
+                writer.write_strip(self.pixels[start:start + 64])
+        return file_path
+
+    def test_tiff_round_trip(self):
+        with Image.open(self.write_tiff(big_tiff=False)) as tiff:
+            np.testing.assert_array_equal(np.asarray(tiff), self.pixels)
+
+    def test_big_tiff_round_trip(self):
+        file_path = self.write_tiff(big_tiff=True)
+        with open(file_path, 'rb') as tiff_file:
+            self.assertEqual(tiff_file.read(4), b'II+\0')
+        with Image.open(file_path) as tiff:
+            np.testing.assert_array_equal(np.asarray(tiff), self.pixels)
+
+    def test_deep_zoom_levels(self):
+        file_path = path.join(self.directory, 'pyramid.dzi')
+        height, width = self.pixels.shape[:2]
+        with DeepZoomWriter(file_path, width, height, tile_size=128, tile_format='png') as writer:
+            for start in range(0, height, 37):
+                writer.write_strip(self.pixels[start:start + 37])
+            max_level = writer.max_level
+
+        size = ElementTree.parse(file_path).getroot()[0].attrib
+        self.assertEqual((int(size['Width']), int(size['Height'])), (width, height))
+
+        # Each level is the level above it halved, down to a single pixel
+        expected = self.pixels
+        for level in range(max_level, -1, -1):
+            folder = path.join(path.splitext(file_path)[0] + "_files", str(level))
+            rows = []
+            for tile_row in range(-(-expected.shape[0] // 128)):
+                rows.append(np.concatenate([np.asarray(Image.open(path.join(folder, "%d_%d.png" % (column, tile_row))))
+                                            for column in range(-(-expected.shape[1] // 128))], axis=1))
+            np.testing.assert_array_equal(np.concatenate(rows), expected)
+            if level:
+                expected = writer.halve(expected)
+        self.assertEqual(expected.shape[:2], (1, 1))
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='mosaic_test_')
+        random = np.random.default_rng(0)
+        tile_folder = path.join(self.directory, 'tiles')
+        makedirs(tile_folder)
+        for index in range(24):
+            make_synthetic_image(random, (48, 40)).save(path.join(tile_folder, '%02d.png' % index))
+        self.micro_images = sorted(list_directory(tile_folder))
+        self.main_image = path.join(self.directory, 'main.png')
+        self.main_pixels = np.array(make_synthetic_image(random, (96, 64)))
+        Image.fromarray(self.main_pixels).save(self.main_image)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_repainted_tiff_matches_full_render(self):
+        collage = path.join(self.directory, 'collage.tif')
+        mosaic_creator = MosaicCreator(block_size=8, alpha_adjustment=0.2, incremental=True, ingest_workers=1)
+        mosaic_creator.create_mosaic(self.micro_images, self.main_image, collage)
+        self.main_pixels[8:30, 20:50] = [250, 20, 20]
+        Image.fromarray(self.main_pixels).save(self.main_image)
+        mosaic_creator.create_mosaic(self.micro_images, self.main_image, collage)
+        self.assertGreater(mosaic_creator.metrics.counters['blocks_repainted'], 0)
+
+        fresh = path.join(self.directory, 'fresh.tif')
+        MosaicCreator(block_size=8, alpha_adjustment=0.2, output_format='tiff',
+                      ingest_workers=1).create_mosaic(self.micro_images, self.main_image, fresh)
+        with Image.open(collage) as repainted, Image.open(fresh) as full:
+            np.testing.assert_array_equal(np.asarray(repainted), np.asarray(full))
+
+
+class MatcherTest(unittest.TestCase):
+    """
+    Every option documented as finding the same micro-images as a full search is checked against one.
+    """
+
+    def setUp(self):
+        random = np.random.default_rng(0)
+        # Smooth blocks repeat and sit close to each other, as in a photograph, which is what the index and the cache
+        # are for
+        self.main_image = np.asarray(make_synthetic_image(random, (160, 120)))
+        self.blocks = MosaicCreator(block_size=4).get_block_features(self.main_image)[0]
+        tiles = [np.asarray(make_synthetic_image(random, (4, 4))) for _ in range(400)]
+        self.tiles = np.stack(tiles).reshape(len(tiles), -1, 3)
+
+    def assert_same_matches(self, metric, **options):
+        full_search = MosaicCreator(block_size=4, metric=metric)
+        expected = full_search.match_features(full_search.prepare_features(self.blocks),
+                                              full_search.prepare_features(self.tiles))
+        mosaic_creator = MosaicCreator(block_size=4, metric=metric, **options)
+        tile_features, tile_index = mosaic_creator.prepare_tiles([(None, tile) for tile in self.tiles])
+        matches = mosaic_creator.match_features(mosaic_creator.prepare_features(self.blocks), tile_features,
+                                                tile_index)
+        np.testing.assert_array_equal(matches, expected)
+
+    def test_grid_index(self):
+        for metric in ('absolute', 'squared', 'lab'):
+            with self.subTest(metric=metric):
+                self.assert_same_matches(metric, match_index='grid')
+
+    def test_exact_candidates(self):
+        for metric in ('absolute', 'squared', 'lab'):
+            with self.subTest(metric=metric):
+                self.assert_same_matches(metric, match_candidates=8, match_exact=True)
+
+    def test_match_cache_step_one(self):
+        for metric in ('absolute', 'squared'):
+            with self.subTest(metric=metric):
+                self.assert_same_matches(metric, match_cache_step=1)
+
+    def test_unbinding_constraints(self):
+        # A limit no micro-image reaches leaves every block with its closest micro-image
+        full_search = MosaicCreator(block_size=4)
+        expected = full_search.match_features(full_search.prepare_features(self.blocks),
+                                              full_search.prepare_features(self.tiles))
+        mosaic_creator = MosaicCreator(block_size=4, max_tile_uses=len(self.blocks))
+        assignment = mosaic_creator.find_closest_tiles(self.main_image, [(None, tile) for tile in self.tiles])
+        np.testing.assert_array_equal(assignment.tile_ids.ravel(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()